@@ -1,9 +1,24 @@
-from .image_db import ImageDB
+from .image_db import CommentResult, ImageDB, SearchResult
+from .ingest import IngestDB, IngestProgress, IngestRecord
+from .deletion import DeletionDB, DeletionProgress
+from .autocomplete import TagAutocomplete
+from .tag_index import Bitmap, TagIndex
+from .query import parse_query, plan
+from .cache import LRUCache
+from .loader import BatchLoader
+from .writer import WriteQueue
+from .invalidation import Invalidator
+from .records import ImageRecord, UserRecord
+from .feed import FeedBuffer
+from .hashing import PasswordHasher
+from .metrics import MetricEvent, Metrics
+from .storage import ImageStorage
+from .dedup import BKTree, DedupIndex
 from .user_db import UserDB
 from .exceptions import *
 
 
-class BooruDatabase(UserDB, ImageDB):
+class BooruDatabase(UserDB, IngestDB, DeletionDB, ImageDB):
     # Merge db classes here
     # UserDB is the first since it requires the loop attr
     pass
@@ -0,0 +1,120 @@
+import heapq
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Tuple
+
+# Prefixes matching more tags than this have their top tags cached
+CACHE_THRESHOLD = 256
+# Number of top tags kept for each cached prefix
+CACHE_DEPTH = 50
+
+
+def prefix_end(prefix: str) -> str:
+    """Get the smallest string greater than every string starting with ``prefix``."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class TagAutocomplete:
+    """Completes tag prefixes from a sorted array of tags, ranked by usage count."""
+
+    def __init__(self, counts: Iterable[Tuple[str, int]]=()):
+        #: Mapping of tag to the number of images it is on.
+        self.counts = {}  # type: Dict[str, int]
+        for tag, count in counts:
+            if count > 0:
+                self.counts[tag.lower()] = count
+        self._tags = sorted(self.counts)
+        # prefix -> top tags, most used first
+        self._top = {}  # type: Dict[str, List[str]]
+
+    def __len__(self):
+        return len(self._tags)
+
+    def _rank(self, tag: str):
+        return (self.counts[tag], tag)
+
+    def complete(self, prefix: str, limit: int=10) -> List[Tuple[str, int]]:
+        """Get the most used tags starting with a prefix.
+
+        :param prefix: The prefix to complete.
+        :param limit: The most tags to return.
+
+        :return: List of (tag, count), most used first.
+        """
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+
+        top = self._top.get(prefix)
+        if top is None or len(top) < limit:
+            lo = bisect_left(self._tags, prefix)
+            hi = bisect_left(self._tags, prefix_end(prefix), lo)
+            matches = self._tags[lo:hi]
+            depth = max(limit, CACHE_DEPTH) if len(matches) > CACHE_THRESHOLD else limit
+            top = heapq.nlargest(depth, matches, key=self._rank)
+            if len(matches) > CACHE_THRESHOLD:
+                self._top[prefix] = top
+
+        return [(i, self.counts[i]) for i in top[:limit]]
+
+    def add(self, *tags: str):
+        """Count one more use of each tag."""
+        for i in map(str.lower, tags):
+            if i not in self.counts:
+                self.counts[i] = 0
+                insort(self._tags, i)
+            self.counts[i] += 1
+            self._raised(i)
+
+    def set_counts(self, counts: Iterable[Tuple[str, int]]):
+        """Set the counts of tags, dropping tags counted 0.
+
+        :param counts: Iterable of (tag, count), such as recounted from the database.
+        """
+        for tag, count in counts:
+            tag = tag.lower()
+            old = self.counts.get(tag, 0)
+            if count > old:
+                if not old:
+                    insort(self._tags, tag)
+                self.counts[tag] = count
+                self._raised(tag)
+            elif count < old:
+                self._lowered(tag)
+                if count > 0:
+                    self.counts[tag] = count
+                else:
+                    del self.counts[tag]
+                    del self._tags[bisect_left(self._tags, tag)]
+
+    def remove(self, *tags: str):
+        """Count one less use of each tag, dropping tags that are no longer used."""
+        for i in map(str.lower, tags):
+            count = self.counts.get(i)
+            if count is None:
+                continue
+            self._lowered(i)
+            if count > 1:
+                self.counts[i] = count - 1
+            else:
+                del self.counts[i]
+                del self._tags[bisect_left(self._tags, i)]
+
+    def _raised(self, tag: str):
+        # Move the tag up in every cached prefix it belongs to
+        for n in range(1, len(tag) + 1):
+            top = self._top.get(tag[:n])
+            if top is None:
+                continue
+            if tag not in top:
+                if len(top) >= CACHE_DEPTH and self._rank(tag) <= self._rank(top[-1]):
+                    continue
+                top.append(tag)
+            top.sort(key=self._rank, reverse=True)
+            del top[CACHE_DEPTH:]
+
+    def _lowered(self, tag: str):
+        # A tag that falls may be overtaken by one that isn't cached, so rebuild lazily
+        for n in range(1, len(tag) + 1):
+            top = self._top.get(tag[:n])
+            if top is not None and tag in top:
+                del self._top[tag[:n]]
@@ -0,0 +1,106 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """A size bounded cache with LRU eviction and a TTL on entries.
+
+    Rows fetched while their key is evicted may be stale, so fetches take a
+    :meth:`token` first and pass it to :meth:`set`, which skips the row if the key
+    was evicted since.
+
+    :param maxsize: Maximum amount of entries to hold.
+    :param ttl: Seconds an entry is valid for, or None to never expire.
+    """
+
+    def __init__(self, maxsize: int=1024, ttl: Optional[float]=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Counts evictions, tokens are its value when a fetch started
+        self._clock = 0
+        # Keys evicted recently, with the clock at their eviction
+        self._evicted = OrderedDict()
+        # Tokens from before this are too old to check against _evicted
+        self._floor = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return self.get(key, count=False) is not None
+
+    def get(self, key: Hashable, default: Any=None, *, count: bool=True) -> Any:
+        """Get an entry from the cache.
+
+        :param key: Key of the entry.
+        :param default: Value to return if the entry does not exist or has expired.
+        :param count: Record this lookup in the hit and miss counters.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires is None or expires > time.monotonic():
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            del self._entries[key]
+
+        if count:
+            self.misses += 1
+        return default
+
+    def token(self) -> int:
+        """Mark the start of fetching a value to :meth:`set`."""
+        return self._clock
+
+    def set(self, key: Hashable, value: Any, token: int=None):
+        """Add an entry to the cache, evicting the least recently used if full.
+
+        :param key: Key of the entry.
+        :param value: The value to store, None is never cached.
+        :param token: The :meth:`token` taken before the value was fetched,
+            it is not stored if the key was evicted since.
+        """
+        if value is None or self.maxsize <= 0:
+            return
+        if token is not None and (token < self._floor or self._evicted.get(key, 0) > token):
+            return
+
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def evict(self, *keys: Hashable):
+        """Remove entries from the cache."""
+        self._clock += 1
+        for i in keys:
+            self._entries.pop(i, None)
+            self._evicted[i] = self._clock
+            self._evicted.move_to_end(i)
+        while len(self._evicted) > max(self.maxsize, 1):
+            _, self._floor = self._evicted.popitem(last=False)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        self._clock += 1
+        self._entries.clear()
+        self._evicted.clear()
+        self._floor = self._clock
+
+    def stats(self) -> dict:
+        """Get the size and hit counters of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
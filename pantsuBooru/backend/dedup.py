@@ -0,0 +1,159 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+HASH_BITS = 64
+
+
+def dhash(im, size: int=8) -> int:
+    """Compute the difference hash of a PIL image.
+
+    Each bit is whether a pixel is brighter than its right neighbour
+    in a ``size + 1`` by ``size`` greyscale thumbnail.
+
+    :return: The hash, a signed 64 bit int so it fits in a postgres BIGINT.
+    """
+    small = im.convert("L").resize((size + 1, size))
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return to_signed(value)
+
+
+def to_signed(value: int) -> int:
+    """Reinterpret an unsigned 64 bit int as signed."""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def hamming(a: int, b: int) -> int:
+    """Count the bits that differ between two hashes."""
+    return bin((a ^ b) & ((1 << HASH_BITS) - 1)).count("1")
+
+
+class BKNode:
+    __slots__ = ("hash", "image_ids", "children")
+
+    def __init__(self, hash: int):
+        self.hash = hash
+        self.image_ids = set()  # type: Set[int]
+        self.children = {}  # type: Dict[int, BKNode]
+
+
+class BKTree:
+    """A BK-tree of perceptual hashes under hamming distance.
+
+    Searches only descend into children whose distance could be in range,
+    so small radius lookups visit a small part of the tree.
+    """
+
+    def __init__(self):
+        self.root = None  # type: Optional[BKNode]
+        self._nodes = {}  # type: Dict[int, BKNode]
+
+    def __len__(self):
+        return sum(len(i.image_ids) for i in self._nodes.values())
+
+    def add(self, hash: int, image_id: int):
+        node = self._nodes.get(hash)
+        if node is not None:
+            node.image_ids.add(image_id)
+            return
+
+        new = self._nodes[hash] = BKNode(hash)
+        new.image_ids.add(image_id)
+        if self.root is None:
+            self.root = new
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(hash, node.hash)
+            child = node.children.get(distance)
+            if child is None:
+                node.children[distance] = new
+                return
+            node = child
+
+    def remove(self, hash: int, image_id: int):
+        # Nodes are kept as the tree's structure depends on them, only the id goes
+        node = self._nodes.get(hash)
+        if node is not None:
+            node.image_ids.discard(image_id)
+
+    def search(self, hash: int, max_distance: int) -> List[Tuple[int, int]]:
+        """Find images with a hash within a distance.
+
+        :param hash: The hash to search around.
+        :param max_distance: The largest hamming distance to return.
+
+        :return: List of (distance, image_id), closest first.
+        """
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(hash, node.hash)
+            if distance <= max_distance:
+                results.extend((distance, i) for i in node.image_ids)
+            for d, child in node.children.items():
+                if distance - max_distance <= d <= distance + max_distance:
+                    stack.append(child)
+        return sorted(results)
+
+
+class DedupIndex:
+    """Exact content hash and perceptual hash index of stored images."""
+
+    def __init__(self):
+        #: Mapping of SHA-256 hex digest to image ID.
+        self.sha256 = {}  # type: Dict[str, int]
+        #: Tree of perceptual hashes.
+        self.tree = BKTree()
+        # image ID -> (sha256, dhash), so images can be removed by ID
+        self._images = {}  # type: Dict[int, Tuple[Optional[str], Optional[int]]]
+
+    def add(self, image_id: int, sha256: str=None, dhash: int=None):
+        """Index an image's hashes, either may be given later."""
+        old_sha, old_dhash = self._images.get(image_id, (None, None))
+        sha256 = sha256 or old_sha
+        if dhash is None:
+            dhash = old_dhash
+        self._images[image_id] = (sha256, dhash)
+
+        if sha256 is not None:
+            self.sha256.setdefault(sha256, image_id)
+        if dhash is not None and dhash != old_dhash:
+            self.tree.add(dhash, image_id)
+
+    def remove(self, *image_ids: int):
+        for i in image_ids:
+            sha256, dhash = self._images.pop(i, (None, None))
+            if sha256 is not None and self.sha256.get(sha256) == i:
+                del self.sha256[sha256]
+            if dhash is not None:
+                self.tree.remove(dhash, i)
+
+    def find_exact(self, sha256: str) -> Optional[int]:
+        """Get the ID of an image with the same content, if any."""
+        return self.sha256.get(sha256)
+
+    def find_similar(self, dhash: int, max_distance: int=8) -> List[Tuple[int, int]]:
+        """Find images that look alike.
+
+        :return: List of (distance, image_id), closest first.
+        """
+        return self.tree.search(dhash, max_distance)
+
+    def hashes(self, image_id: int) -> Tuple[Optional[str], Optional[int]]:
+        """Get the (sha256, dhash) of an indexed image."""
+        return self._images.get(image_id, (None, None))
+
+    @classmethod
+    def build(cls, rows: Iterable[Tuple[int, Optional[str], Optional[int]]]) -> 'DedupIndex':
+        """Build an index from (image_id, sha256, dhash) rows."""
+        index = cls()
+        for image_id, sha256, dhash in rows:
+            index.add(image_id, sha256, dhash)
+        return index
@@ -0,0 +1,137 @@
+import logging
+import time
+from typing import Callable, List, NamedTuple
+
+from .image_db import ImageDB
+
+log = logging.getLogger(__name__)
+
+
+class DeletionProgress(NamedTuple):
+    """Progress of a running bulk user deletion."""
+
+    users: int
+    images: int
+    comments: int
+    elapsed: float
+
+
+class DeletionDB(ImageDB):
+    async def delete_users(self,
+                           *user_ids: int,
+                           batch_size: int=1000,
+                           users_per_batch: int=100,
+                           progress: Callable[[DeletionProgress], None]=None) -> DeletionProgress:
+        """Delete users with their images and comments, in batches of short transactions.
+
+        Images are deleted ``batch_size`` at a time, their tag links, comments,
+        files, cache entries and in memory index entries with them,
+        then the users' comments on other images, then the users.
+        No transaction touches more than ``batch_size`` images or comments,
+        so even users with huge galleries never hold long locks.
+
+        :param user_ids: IDs of the users to delete.
+        :param batch_size: Most images or comments deleted per transaction.
+        :param users_per_batch: Most users whose images are deleted together.
+        :param progress: Called with a :class:`DeletionProgress` after every batch.
+
+        :return: The final :class:`DeletionProgress`.
+        """
+        # Queued comments and tag edits of the users' images would fail afterwards
+        await self.flush_writes()
+
+        users = images = comments = 0
+        start = time.monotonic()
+        stats = DeletionProgress(0, 0, 0, 0.0)
+
+        def report():
+            nonlocal stats
+            stats = DeletionProgress(users, images, comments, time.monotonic() - start)
+            log.info("Deleted %d users, %d images and %d comments",
+                     stats.users, stats.images, stats.comments)
+            if progress is not None:
+                progress(stats)
+
+        for i in range(0, len(user_ids), users_per_batch):
+            batch = list(user_ids[i:i + users_per_batch])
+
+            while True:
+                deleted, deleted_comments = await self._delete_user_images(batch, batch_size)
+                if not deleted:
+                    break
+                images += len(deleted)
+                comments += deleted_comments
+                report()
+
+            while True:
+                deleted_comments = await self._delete_user_comments(batch, batch_size)
+                if not deleted_comments:
+                    break
+                comments += deleted_comments
+                report()
+
+            async with self.db.get_session() as s:
+                q = await s.cursor("""
+                    DELETE FROM "user" WHERE "id" = ANY($1::integer[]) RETURNING "id"
+                """, {"$1": batch})
+                async with q as c:
+                    users += len([i async for i in c])
+
+            self.evict_users(*batch)
+            report()
+
+        return stats
+
+    async def _delete_user_images(self, user_ids: List[int], limit: int) -> (List[int], int):
+        """Delete a batch of the images posted by users.
+
+        :return: The IDs of the images deleted and the amount of their comments deleted.
+        """
+        async with self.db.get_session() as s:
+            q = await s.cursor("""SELECT "id" FROM "image"
+                                  WHERE "poster" = ANY($1::integer[])
+                                  ORDER BY "id"
+                                  LIMIT $2
+                                  FOR UPDATE""",
+                               {"$1": user_ids, "$2": limit})
+            async with q as c:
+                image_ids = [i["id"] async for i in c]
+            if not image_ids:
+                return [], 0
+
+            # Tag links are removed first, so orphaned tags are handled
+            # as they are when tags are removed
+            unlinked = await self._unlink_tags(s, image_ids)
+
+            q = await s.cursor("""
+                DELETE FROM "comment"
+                WHERE "comment"."image_id" = ANY($1::integer[])
+                RETURNING "comment"."id"
+            """, {"$1": image_ids})
+            async with q as c:
+                comments = len([i async for i in c])
+            await s.execute("""DELETE FROM "image" WHERE "id" = ANY($1::integer[])""",
+                            {"$1": image_ids})
+
+        self._images_deleted(*image_ids, unlinked=unlinked)
+
+        return image_ids, comments
+
+    async def _delete_user_comments(self, user_ids: List[int], limit: int) -> int:
+        """Delete a batch of the comments users posted on other images.
+
+        :return: The amount of comments deleted.
+        """
+        async with self.db.get_session() as s:
+            q = await s.cursor("""
+                DELETE FROM "comment"
+                WHERE "id" IN (SELECT "id" FROM "comment"
+                               WHERE "poster" = ANY($1::integer[])
+                               LIMIT $2)
+                RETURNING "image_id"
+            """, {"$1": user_ids, "$2": limit})
+            async with q as c:
+                image_ids = [i["image_id"] async for i in c]
+
+        self.evict_images(*set(image_ids))
+        return len(image_ids)
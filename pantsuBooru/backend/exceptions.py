@@ -29,3 +29,25 @@ class TagExists(BooruException):
     """Raised when a tag already existed for an image it was added to."""
 
     reason = "A tag of the same value already existed for that image."
+
+
+class HashQueueFull(BooruException):
+    """Raised when too many passwords are waiting to be hashed."""
+
+    reason = "Too many passwords are being hashed, try again later."
+
+
+class DuplicateImage(BooruException):
+    """Raised when an uploaded image has the same content as an existing image."""
+
+    reason = "An image with the same content already exists."
+
+    def __init__(self, image_id: int, *args):
+        super().__init__(image_id, *args)
+        self.image_id = image_id
+
+
+class BadQuery(BooruException):
+    """Raised when a tag search query can't be parsed."""
+
+    reason = "The search query is not valid."
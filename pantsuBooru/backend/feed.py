@@ -0,0 +1,111 @@
+import bisect
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .records import ImageRecord
+
+#: Position of an image in a feed, newest images have the greatest.
+FeedCursor = Tuple[datetime, int]
+
+
+def feed_cursor(record: ImageRecord) -> FeedCursor:
+    return (record.posted_at, record.id)
+
+
+class FeedBuffer:
+    """A ring buffer of the newest images, so the first pages of feeds skip the database.
+
+    It always holds a contiguous run of the newest images. Images older than
+    all of them are unknown, so a page is only served from the buffer if it fills up
+    inside it, or the buffer holds every image.
+
+    Only changes made through this process are seen.
+
+    :param size: Most images held, the oldest are dropped past it.
+    """
+
+    def __init__(self, size: int=500):
+        self.size = size
+        # Oldest first, so new images are appended
+        self.cursors = []  # type: List[FeedCursor]
+        self.records = []  # type: List[ImageRecord]
+        self.by_id = {}  # type: Dict[int, ImageRecord]
+        #: If every image in the database is held.
+        self.complete = True
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, image_id: int):
+        return image_id in self.by_id
+
+    def load(self, records: Iterable[ImageRecord], complete: bool):
+        """Replace the contents.
+
+        :param records: The newest images, in any order.
+        :param complete: If they are every image in the database.
+        """
+        self.records = sorted(records, key=feed_cursor)[-self.size:]
+        self.cursors = [feed_cursor(i) for i in self.records]
+        self.by_id = {i.id: i for i in self.records}
+        self.complete = complete
+
+    def add(self, record: ImageRecord):
+        """Add a new image, or replace it if it is held."""
+        if record.id in self.by_id:
+            self.remove(record.id)
+
+        cursor = feed_cursor(record)
+        if not self.complete and (not self.cursors or cursor < self.cursors[0]):
+            # Older than the run held, images between them may be missing
+            return
+
+        i = bisect.bisect(self.cursors, cursor)
+        self.cursors.insert(i, cursor)
+        self.records.insert(i, record)
+        self.by_id[record.id] = record
+
+        if len(self.records) > self.size:
+            del self.by_id[self.records[0].id]
+            del self.cursors[0], self.records[0]
+            self.complete = False
+
+    def remove(self, *image_ids: int):
+        """Remove deleted images."""
+        removed = {i for i in image_ids if self.by_id.pop(i, None) is not None}
+        if removed:
+            keep = [i for i, record in enumerate(self.records) if record.id not in removed]
+            self.cursors = [self.cursors[i] for i in keep]
+            self.records = [self.records[i] for i in keep]
+
+    def replace(self, image_id: int, **fields):
+        """Change the fields of a held image, such as its tags or poster."""
+        record = self.by_id.get(image_id)
+        if record is None:
+            return
+        i = bisect.bisect_left(self.cursors, feed_cursor(record))
+        self.records[i] = self.by_id[image_id] = record._replace(**fields)
+
+    def page(self, limit: int, before: FeedCursor=None,
+             predicate: Callable[[ImageRecord], bool]=None) -> Optional[List[ImageRecord]]:
+        """Get a page of a feed, if it can be answered from the buffer.
+
+        :param limit: Limit of images to return.
+        :param before: Only return images older than this cursor.
+        :param predicate: Only return images it returns True for.
+
+        :return: List of :class:`ImageRecord`, newest first, or None if the page
+            reaches past the images held.
+        """
+        end = len(self.cursors) if before is None else bisect.bisect_left(self.cursors, before)
+        page = []
+        for i in range(end - 1, -1, -1):
+            if len(page) >= limit:
+                return page
+            record = self.records[i]
+            if predicate is None or predicate(record):
+                page.append(record)
+
+        if len(page) >= limit or self.complete:
+            return page
+        return None
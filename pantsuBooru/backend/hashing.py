@@ -0,0 +1,127 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from passlib.hash import bcrypt
+
+from .exceptions import HashQueueFull
+
+
+def _hash(password: str) -> str:
+    return bcrypt.hash(password)
+
+
+def _verify(password: str, hash: str) -> bool:
+    return bcrypt.verify(password, hash)
+
+
+class PasswordHasher:
+    """Runs bcrypt in a dedicated worker pool with a bounded queue.
+
+    :param workers: Size of the worker pool.
+    :param max_pending: Most hashes that may be queued or running at once.
+    :param timeout: Seconds to wait for a queue slot before raising :class:`HashQueueFull`.
+        0 rejects immediately when full, None waits forever.
+    :param processes: Use a process pool rather than a thread pool.
+    :param loop: The event loop to use.
+    """
+
+    def __init__(self,
+                 workers: int=2,
+                 max_pending: int=64,
+                 timeout: Optional[float]=5,
+                 processes: bool=True,
+                 loop: asyncio.AbstractEventLoop=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.processes = processes
+        self.loop = loop or asyncio.get_event_loop()
+
+        self._executor = None  # type: Executor
+        self._slots = asyncio.Semaphore(max_pending)
+
+        self.waiting = 0
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=1000)
+
+    @property
+    def executor(self) -> Executor:
+        """The worker pool, created on first use."""
+        if self._executor is None:
+            pool = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+            self._executor = pool(max_workers=self.workers)
+        return self._executor
+
+    async def _run(self, fn, *args):
+        self.waiting += 1
+        try:
+            if self.timeout is not None and self._slots.locked():
+                if self.timeout <= 0:
+                    raise HashQueueFull
+                try:
+                    await asyncio.wait_for(self._slots.acquire(), self.timeout)
+                except asyncio.TimeoutError:
+                    raise HashQueueFull from None
+            else:
+                await self._slots.acquire()
+        except HashQueueFull:
+            self.rejected += 1
+            raise
+        finally:
+            self.waiting -= 1
+
+        self.pending += 1
+        start = time.monotonic()
+        try:
+            return await self.loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            self.latencies.append(time.monotonic() - start)
+            self.completed += 1
+            self.pending -= 1
+            self._slots.release()
+
+    def hash(self, password: str):
+        """Hash a password with bcrypt.
+
+        This function returns a coroutine.
+        """
+        return self._run(_hash, password)
+
+    def verify(self, password: str, hash: str):
+        """Check a password against a bcrypt hash.
+
+        This function returns a coroutine.
+        """
+        return self._run(_verify, password, hash)
+
+    def stats(self) -> dict:
+        """Get the queue depth and hash latency of the pool."""
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "waiting": self.waiting,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "latency_p50": percentile(0.5),
+            "latency_p99": percentile(0.99),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+    def shutdown(self, wait: bool=True):
+        """Shut down the worker pool."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
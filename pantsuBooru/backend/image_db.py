@@ -1,41 +1,666 @@
+import asyncio
+import functools
+import logging
+import math
+import re
 from datetime import datetime
-from typing import Iterable
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
-from pantsuBooru.backend.exceptions import TagExists
-from pantsuBooru.models import Image, Tag, ImageTag, User, Comment
+from pantsuBooru.backend.exceptions import DuplicateImage, NoImage, TagExists
+from pantsuBooru.models import Image, Tag, ImageTag, Comment
 
-from .utils import BaseDatabase
+from .autocomplete import TagAutocomplete, prefix_end
+from .dedup import DedupIndex
+from .feed import FeedBuffer, FeedCursor
+from .loader import BatchLoader
+from .query import (NOTHING, AndTerm, TagTerm, Term, compile_query, evaluate, parse_query,
+                    plan, query_tags)
+from .records import ImageRecord, UserRecord
+from .storage import Upload
+from .tag_index import TagIndex
+from .utils import BaseDatabase, BoundInterface, row_from_record
+from .writer import WriteQueue
 
+from asyncqlio.exc import IntegrityError
 from asyncqlio.orm.operators import In
 
+log = logging.getLogger(__name__)
+
+# Columns of an image, named as on the model
+IMAGE_COLUMNS = """
+    "image"."id", "image"."posted_at", "image"."author",
+    "image"."source", "image"."sha256", "image"."dhash",
+    "image"."poster" AS "poster_id"
+"""
+
+# Columns of an image, its tags and its poster's public fields, fetched for each search result
+RESULT_COLUMNS = IMAGE_COLUMNS + """,
+    ARRAY(SELECT "t"."tag"
+          FROM "imagetag" AS "it"
+          JOIN "tag" AS "t" ON "t"."id" = "it"."tag_id"
+          WHERE "it"."image_id" = "image"."id"
+          ORDER BY "it"."id") AS "tags",
+    "user"."id" AS "user_id", "user"."joined_at" AS "user_joined_at",
+    "user"."username" AS "user_username"
+"""
+
+
+# Count of a tag including the changes not yet folded in, see ImageDB.fold_tag_counts
+EXACT_COUNT = """
+    "tag"."count" + COALESCE((SELECT SUM("tagcountdelta"."delta") FROM "tagcountdelta"
+                              WHERE "tagcountdelta"."tag_id" = "tag"."id"), 0)
+"""
+
+# Arbitrary key of the advisory lock held while folding tag counts
+FOLD_LOCK_KEY = 0x74616763
+
+
+# Text columns of an image that can be searched, see ImageDB.search_images_text
+TEXT_FIELDS = ("author", "source")
+
+
+def unique_tags(tags: Iterable[str]) -> List[str]:
+    """Lowercase tags and remove duplicates, keeping their order."""
+    return list(dict.fromkeys(map(str.lower, tags)))
+
+
+class SearchResult(NamedTuple):
+    """A single ranked result of a tag search."""
+
+    image: Image
+    poster: Optional[UserRecord]
+    tags: List[str]
+    matches: int
+
+    @property
+    def cursor(self) -> Tuple[int, int]:
+        """The keyset cursor to fetch the page after this result with."""
+        return (self.matches, self.image.id)
+
+
+class CommentResult(NamedTuple):
+    """A single ranked result of a comment search."""
+
+    comment: Comment
+    rank: float
+
+    @property
+    def cursor(self) -> Tuple[float, int]:
+        """The keyset cursor to fetch the page after this result with."""
+        return (self.rank, self.comment.id)
+
+
+def result_from_record(record: dict, matches: int=None) -> SearchResult:
+    """Build a :class:`SearchResult` from a record selected with :data:`RESULT_COLUMNS`."""
+    return SearchResult(image=row_from_record(Image, record),
+                        poster=UserRecord.from_record(record, "user_"),
+                        tags=list(record["tags"]),
+                        matches=record["matches"] if matches is None else matches)
+
 
 class ImageDB(BaseDatabase):
+    _held_indexes = {
+        "tag_index": ("add", "remove", "clear_tags", "discard_images"),
+        "tag_autocomplete": ("add", "remove"),
+        "dedup_index": ("add", "remove"),
+        "feed": ("add", "remove", "replace"),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        #: IDs of tags that may have been orphaned, swept by the tag gc when it is running.
+        self.orphan_tags = set()
+        self._tag_gc = None
+        self._stats_refresh = None
+        self._comment_writes = None  # type: Optional[WriteQueue]
+        self._tag_writes = None  # type: Optional[WriteQueue]
+
+    def _make_loaders(self):
+        super()._make_loaders()
+        #: Batches tag lookups of images built at the same time, see :meth:`get_image_tags`.
+        self.tag_loader = BatchLoader(self.get_image_tags, key=None, loop=self.loop)
+
+    #: The in memory :class:`TagIndex`, if it has been loaded.
+    tag_index = None  # type: Optional[TagIndex]
+
+    async def load_tag_index(self) -> TagIndex:
+        """Build the in memory tag index from the database.
+
+        Once loaded, tag searches are answered from the index
+        and tag edits made through this object keep it up to date.
+
+        :return: The loaded :class:`TagIndex`.
+        """
+        index = TagIndex()
+
+        async with self.db.get_session() as s:
+            q = await s.cursor('SELECT "image"."id" FROM "image"')
+            async with q as c:
+                async for i in c:
+                    index.images.add(i["id"])
+
+            q = await s.cursor("""
+                SELECT "imagetag"."image_id", "tag"."tag"
+                FROM "imagetag"
+                JOIN "tag" ON "tag"."id" = "imagetag"."tag_id"
+            """)
+            async with q as c:
+                async for i in c:
+                    index.add(i["image_id"], i["tag"])
+
+        self.tag_index = index
+        return index
+
+    #: The in memory :class:`TagAutocomplete`, if it has been loaded.
+    tag_autocomplete = None  # type: Optional[TagAutocomplete]
+    # Names of the tags by ID, for recounting tags other processes have deleted
+    _tag_names = None  # type: Optional[Dict[int, str]]
+
+    async def load_tag_autocomplete(self) -> TagAutocomplete:
+        """Build the in memory tag autocompleter from the database.
+
+        :return: The loaded :class:`TagAutocomplete`.
+        """
+        async with self.db.get_session() as s:
+            # Exact, as the counts are only changed incrementally from here on
+            q = await s.cursor(f"""SELECT "tag"."id", "tag"."tag", {EXACT_COUNT} AS "count"
+                                   FROM "tag"
+                                """)
+            async with q as c:
+                rows = [i async for i in c]
+
+        self._tag_names = {i["id"]: i["tag"] for i in rows}
+        self.tag_autocomplete = TagAutocomplete((i["tag"], i["count"]) for i in rows)
+        return self.tag_autocomplete
+
+    async def _recount_autocomplete(self, tag_ids: List[int]):
+        """Set the autocomplete counts of tags changed by another process."""
+        async with self.db.get_session() as s:
+            q = await s.cursor(f"""SELECT "tag"."id", "tag"."tag", {EXACT_COUNT} AS "count"
+                                   FROM "tag"
+                                   WHERE "tag"."id" = ANY($1::integer[])""",
+                               {"$1": tag_ids})
+            async with q as c:
+                rows = [i async for i in c]
+
+        counts = {self._tag_names[i]: 0 for i in tag_ids if i in self._tag_names}
+        for i in rows:
+            self._tag_names[i["id"]] = i["tag"]
+            counts[i["tag"]] = i["count"]
+        self.tag_autocomplete.set_counts(counts.items())
+
+    async def autocomplete_tags(self, prefix: str, limit: int=10) -> [(str, int)]:
+        """Get the most used tags starting with a prefix.
+
+        :param prefix: The prefix to complete.
+        :param limit: Limit of tags to return.
+
+        :return: List of (tag, count) ordered by most used.
+        """
+        if self.tag_autocomplete is not None:
+            return self.tag_autocomplete.complete(prefix, limit)
+
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+
+        query = f"""SELECT "tag", "count"
+        FROM (SELECT "tag"."tag", {EXACT_COUNT} AS "count"
+              FROM "tag"
+              WHERE "tag"."tag" >= $1 AND "tag"."tag" < $2) AS "tag"
+        WHERE "count" > 0
+        ORDER BY "count" DESC, "tag" DESC
+        LIMIT $3
+        """
+
+        params = {"$1": prefix, "$2": prefix_end(prefix), "$3": limit}
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, params)
+            async with q as c:
+                return [(i["tag"], i["count"]) async for i in c]
+
+    async def get_tag_counts(self, *tags: str) -> Dict[str, int]:
+        """Get the amount of images with each of some tags.
+
+        :param tags: The tags to count.
+
+        :return: Dict of tag to count, tags that don't exist are left out.
+        """
+        async with self.db.get_session() as s:
+            q = await s.cursor(f"""SELECT "tag"."tag", {EXACT_COUNT} AS "count" FROM "tag"
+                                   WHERE "tag"."tag" = ANY($1::text[])""",
+                               {"$1": [i.lower() for i in tags]})
+            async with q as c:
+                return {i["tag"]: i["count"] async for i in c}
+
+    async def top_tags(self, limit: int=50) -> [(str, int)]:
+        """Get the most used tags.
+
+        Read from the counts as of the last :meth:`fold_tag_counts`.
+
+        :param limit: Limit of tags to return.
+
+        :return: List of (tag, count) ordered by most used.
+        """
+        async with self.db.get_session() as s:
+            q = await s.cursor("""SELECT "tag"."tag", "tag"."count" FROM "tag"
+                                  WHERE "tag"."count" > 0
+                                  ORDER BY "tag"."count" DESC
+                                  LIMIT $1""",
+                               {"$1": limit})
+            async with q as c:
+                return [(i["tag"], i["count"]) async for i in c]
+
+    async def tag_cloud(self, limit: int=100, levels: int=5) -> [(str, int, int)]:
+        """Get the most used tags, weighted for display as a tag cloud.
+
+        Read from the counts as of the last :meth:`fold_tag_counts`.
+
+        :param limit: Limit of tags to return.
+        :param levels: Amount of different weights.
+
+        :return: List of (tag, count, weight) ordered by tag, weights go from 1 to ``levels``
+            on a log scale of the counts.
+        """
+        tags = await self.top_tags(limit)
+        if not tags:
+            return []
+        low, high = math.log(tags[-1][1]), math.log(tags[0][1])
+        spread = (high - low) or 1
+        return sorted((tag, count, 1 + round((math.log(count) - low) / spread * (levels - 1)))
+                      for tag, count in tags)
+
+    async def related_tags(self, tag: str, limit: int=10) -> [(str, int)]:
+        """Get the tags most often on the same images as a tag.
+
+        These are read from a summary refreshed by :meth:`refresh_related_tags`,
+        so recent changes may not be included yet.
+
+        :param tag: The tag to find related tags of.
+        :param limit: Limit of tags to return.
+
+        :return: List of (tag, images with both tags) ordered by most images.
+        """
+        query = """SELECT "related"."tag", "tagrelation"."count"
+        FROM "tag"
+        JOIN "tagrelation" ON "tagrelation"."tag_id" = "tag"."id"
+        JOIN "tag" AS "related" ON "related"."id" = "tagrelation"."related_id"
+        WHERE "tag"."tag" = $1
+        ORDER BY "tagrelation"."count" DESC
+        LIMIT $2
+        """
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, {"$1": tag.lower(), "$2": limit})
+            async with q as c:
+                return [(i["tag"], i["count"]) async for i in c]
+
+    async def refresh_related_tags(self, limit: int=100, sample: int=10000,
+                                   keep: int=100) -> int:
+        """Recompute the related tags of tags whose images have changed.
+
+        :param limit: Most tags to recompute in one call.
+        :param sample: Co-occurrences are counted over at most this many of a tag's newest images,
+            so popular tags cost the same as rare ones.
+        :param keep: Amount of related tags stored per tag.
+
+        :return: The amount of tags recomputed.
+        """
+        async with self.db.get_session() as s:
+            # Marked fresh first, so changes made while recomputing mark them stale again
+            q = await s.cursor("""
+                UPDATE "tag" SET "related_stale" = FALSE
+                WHERE "tag"."id" IN (SELECT "id" FROM "tag" WHERE "related_stale"
+                                     LIMIT $1
+                                     FOR UPDATE SKIP LOCKED)
+                RETURNING "tag"."id"
+            """, {"$1": limit})
+            async with q as c:
+                tag_ids = [i["id"] async for i in c]
+            if not tag_ids:
+                return 0
+
+            await s.execute("""DELETE FROM "tagrelation"
+                               WHERE "tagrelation"."tag_id" = ANY($1::integer[])""",
+                            {"$1": tag_ids})
+            await s.execute("""
+                INSERT INTO "tagrelation" ("tag_id", "related_id", "count")
+                SELECT "tag_id", "related_id", "count" FROM (
+                    SELECT "sampled"."tag_id", "other"."tag_id" AS "related_id",
+                           COUNT(*) AS "count",
+                           ROW_NUMBER() OVER (PARTITION BY "sampled"."tag_id"
+                                              ORDER BY COUNT(*) DESC) AS "rank"
+                    FROM "tag"
+                    CROSS JOIN LATERAL (
+                        SELECT "imagetag"."tag_id", "imagetag"."image_id"
+                        FROM "imagetag"
+                        WHERE "imagetag"."tag_id" = "tag"."id"
+                        ORDER BY "imagetag"."image_id" DESC
+                        LIMIT $2
+                    ) AS "sampled"
+                    JOIN "imagetag" AS "other"
+                        ON "other"."image_id" = "sampled"."image_id"
+                            AND "other"."tag_id" <> "sampled"."tag_id"
+                    WHERE "tag"."id" = ANY($1::integer[])
+                    GROUP BY "sampled"."tag_id", "other"."tag_id"
+                ) AS "ranked"
+                WHERE "rank" <= $3
+            """, {"$1": tag_ids, "$2": sample, "$3": keep})
+
+        return len(tag_ids)
+
+    async def fold_tag_counts(self) -> int:
+        """Add the changes triggers recorded in "tagcountdelta" to the tag counts.
+
+        The tags changed are marked for :meth:`refresh_related_tags`.
+        Until folded, :meth:`top_tags` and :meth:`tag_cloud` leave the changes out.
+        Call it regularly, :meth:`start_stats_refresh` does, or "tagcountdelta" grows
+        without limit.
+
+        :return: The amount of tags updated.
+        """
+        async with self.db.get_session() as s:
+            # Two folds would lock the same tags in different orders
+            await s.execute("SELECT pg_advisory_xact_lock($1)", {"$1": FOLD_LOCK_KEY})
+            # Only deltas committed before the delete started are removed and added
+            status = await s.execute("""
+                WITH "folded" AS (
+                    DELETE FROM "tagcountdelta" RETURNING "tag_id", "delta"
+                )
+                UPDATE "tag" SET "count" = "tag"."count" + "summed"."delta",
+                                 "related_stale" = TRUE
+                FROM (SELECT "tag_id", SUM("delta") AS "delta"
+                      FROM "folded" GROUP BY "tag_id") AS "summed"
+                WHERE "tag"."id" = "summed"."tag_id"
+            """)
+        return int(status.split()[-1])
+
+    async def refresh_tag_counts(self):
+        """Recount the images of every tag from scratch and mark all related tags stale.
+
+        Counts are kept up to date by triggers and :meth:`fold_tag_counts`, this repairs them
+        after the triggers were disabled or when the columns are first added
+        to an existing database.
+        """
+        async with self.db.get_session() as s:
+            await s.execute("SELECT pg_advisory_xact_lock($1)", {"$1": FOLD_LOCK_KEY})
+            # One statement, so the deltas discarded are exactly those the recount includes
+            await s.execute("""
+                WITH "discarded" AS (DELETE FROM "tagcountdelta")
+                UPDATE "tag" SET "related_stale" = TRUE, "count" = (
+                    SELECT COUNT(*) FROM "imagetag"
+                    WHERE "imagetag"."tag_id" = "tag"."id")
+            """)
+
+    def start_stats_refresh(self, interval: float=300, limit: int=100):
+        """Fold tag counts and refresh related tags on a schedule.
+
+        Tag counts only change once folded, so at least one process must run this
+        or call :meth:`fold_tag_counts` itself.
+
+        :param interval: Seconds between refreshes.
+        :param limit: Most tags to refresh each time.
+        """
+        if self._stats_refresh is None:
+            self._stats_refresh = self.loop.create_task(self._run_stats_refresh(interval, limit))
+
+    async def stop_stats_refresh(self):
+        """Stop the scheduled tag count and related tag refresh."""
+        task, self._stats_refresh = self._stats_refresh, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run_stats_refresh(self, interval: float, limit: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.fold_tag_counts()
+            except Exception:
+                log.exception("Folding tag counts failed")
+            try:
+                # Keep going while there is a backlog of stale tags
+                while await self.refresh_related_tags(limit) >= limit:
+                    pass
+            except Exception:
+                log.exception("Refreshing related tags failed")
+
+    #: The in memory :class:`DedupIndex`, if it has been loaded.
+    dedup_index = None  # type: Optional[DedupIndex]
+
+    async def load_dedup_index(self) -> DedupIndex:
+        """Build the in memory content hash index from the database.
+
+        :return: The loaded :class:`DedupIndex`.
+        """
+        async with self.db.get_session() as s:
+            q = await s.cursor("""
+                SELECT "id", "sha256", "dhash"
+                FROM "image"
+                WHERE "sha256" IS NOT NULL OR "dhash" IS NOT NULL
+            """)
+            async with q as c:
+                rows = [(i["id"], i["sha256"], i["dhash"]) async for i in c]
+
+        self.dedup_index = DedupIndex.build(rows)
+        return self.dedup_index
+
+    async def find_duplicate(self, sha256: str) -> Optional[int]:
+        """Find an image with exactly the same content.
+
+        :param sha256: Hex SHA-256 of the file.
+
+        :return: ID of the existing image, if any.
+        """
+        if self.dedup_index is not None:
+            return self.dedup_index.find_exact(sha256)
+
+        async with self.db.get_session() as s:
+            record = await s.fetch("""SELECT "id" FROM "image" WHERE "sha256" = $1 LIMIT 1""",
+                                   {"$1": sha256})
+        return None if record is None else record["id"]
+
+    async def find_similar_images(self, image_id: int,
+                                  max_distance: int=8) -> [(Image, int)]:
+        """Find images that look like another.
+
+        Without the :attr:`dedup_index` loaded, the hash of every image is compared,
+        so load it with :meth:`load_dedup_index` for lookups that don't scan the table.
+
+        :param image_id: ID of the image to compare against.
+        :param max_distance: The most bits the perceptual hashes may differ by.
+
+        :return: List of (:class:`pantsuBooru.models.Image`, distance), closest first.
+        """
+        if self.dedup_index is not None:
+            _, dhash = self.dedup_index.hashes(image_id)
+            if dhash is None:
+                return []
+            similar = [(i, d) for d, i in self.dedup_index.find_similar(dhash, max_distance)
+                       if i != image_id]
+            images = {i.id: i for i in await self.get_many_images(*(i for i, _ in similar))}
+            return [(images[i], d) for i, d in similar if i in images]
+
+        # A linear scan, there is no index to search hamming distances with
+        query = f"""SELECT {IMAGE_COLUMNS}, "distance"
+        FROM (
+            SELECT "image".*,
+                   length(replace(("image"."dhash" # "target"."dhash")::bit(64)::text,
+                                  '0', '')) AS "distance"
+            FROM "image", (SELECT "dhash" FROM "image" WHERE "id" = $1) AS "target"
+            WHERE "image"."id" <> $1 AND "image"."dhash" IS NOT NULL
+        ) AS "image"
+        WHERE "distance" <= $2
+        ORDER BY "distance", "id"
+        """
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, {"$1": image_id, "$2": max_distance})
+            async with q as c:
+                return [(row_from_record(Image, i), i["distance"]) async for i in c]
+
+    async def _store_dhash(self, image_id: int, converted: asyncio.Future):
+        """Save the perceptual hash of an image once its conversion finishes."""
+        try:
+            dhash = await converted
+        except Exception:
+            return  # Logged by the storage
+
+        async with self.db.get_session() as s:
+            updated = await s.fetch("""UPDATE "image" SET "dhash" = $1 WHERE "id" = $2
+                                       RETURNING "id"
+                                    """,
+                                    {"$1": dhash, "$2": image_id})
+        if updated is None:
+            return  # Deleted while it was converted
+
+        self.evict_images(image_id)
+        self.publish("image_changed", image_id)
+        if self.dedup_index is not None:
+            self.dedup_index.add(image_id, dhash=dhash)
+            similar = [i for _, i in self.dedup_index.find_similar(dhash, 4) if i != image_id]
+            if similar:
+                log.info("Image %d looks like %s", image_id, similar)
+
     async def add_image(self,
                         author: str,
                         source: str,
                         user_id: int,
-                        tags: Iterable[str]) -> Image:
+                        tags: Iterable[str],
+                        upload: Upload=None) -> Image:
         """Add an image.
 
         :param author: The author of the image.
         :param source: The source url of the image.
         :param user_id: ID of user that posted the image.
         :param tags: List of tags to insert with the image.
+        :param upload: The image file, as bytes, a file like object or an async iterable of bytes.
+            It is streamed to disk and converted in the background once the row is committed.
+
+        :raises DuplicateImage: If the upload has the same content as an existing image.
 
         :return: The :class:`pantsuBooru.models.Image` object inserted into the database.
         """
+        received = None
+        if upload is not None:
+            if self.storage is None:
+                raise RuntimeError("No image storage is attached to store the upload in")
+            received = await self.storage.receive(upload)
+
+            existing = await self.find_duplicate(received.sha256)
+            if existing is not None:
+                self.storage.discard(received)
+                raise DuplicateImage(existing)
+
         image = Image(
             posted_at=datetime.utcnow(),
             author=author,
             source=source,
+            sha256=received and received.sha256,
             poster=user_id)
 
-        async with self.db.get_session() as s:
-            [image] = await s.insert.add_row(image)
+        try:
+            # Without its tags, the image is not committed either
+            async with self.transaction() as db:
+                async with db.db.get_session() as s:
+                    [image] = await s.insert.add_row(image)
+                await db.insert_tags(image.id, *tags)
+        except BaseException as e:
+            if received is not None:
+                self.storage.discard(received)
+            # The unique index added by migration 3, the same content was uploaded meanwhile
+            if (isinstance(e, IntegrityError)
+                    and getattr(e.__cause__, "constraint_name", None) == "image_sha256_idx"):
+                async with self.db.get_session() as s:
+                    record = await s.fetch("""SELECT "id" FROM "image" WHERE "sha256" = $1""",
+                                           {"$1": received.sha256})
+                raise DuplicateImage(record and record["id"]) from None
+            raise
 
-        await self.insert_tags(image.id, *tags)
+        if received is not None:
+            converted = self.storage.store(image.id, received)
+            self.loop.create_task(self._store_dhash(image.id, converted))
+            if self.dedup_index is not None:
+                self.dedup_index.add(image.id, sha256=received.sha256)
+        if self.feed is not None:
+            # The poster is filled in when the image is first served
+            self.feed.add(ImageRecord(image.id, image.posted_at, author, source, user_id,
+                                      tuple(unique_tags(tags)), None))
+        self.evict_users(user_id)
         return image
 
+    async def _invalidate(self, kind: str, ids: List[int]):
+        await super()._invalidate(kind, ids)
+
+        if kind == "tag":
+            # Counts of tags linked or unlinked, published along with the images changed
+            if self.tag_autocomplete is not None:
+                await self._recount_autocomplete(ids)
+
+        elif kind == "image_deleted":
+            self.image_cache.evict(*ids)
+            # The autocomplete counts come with the "tag" event
+            self._discard_images(ids)
+
+        elif kind == "image_changed":
+            # Added, retagged or hashed, the loaded indexes are refreshed from the database
+            self.image_cache.evict(*ids)
+            if self.tag_index is None and self.dedup_index is None and self.feed is None:
+                return
+
+            async with self.db.get_session() as s:
+                q = await s.cursor(f"""SELECT {RESULT_COLUMNS}
+                                       FROM "image"
+                                       LEFT JOIN "user" ON "user"."id" = "image"."poster"
+                                       WHERE "image"."id" = ANY($1::integer[])""",
+                                   {"$1": ids})
+                async with q as c:
+                    records = [i async for i in c]
+
+            for i in records:
+                image_id, tags = i["id"], tuple(i["tags"])
+                if self.tag_index is not None:
+                    self.tag_index.clear_tags(image_id)
+                    self.tag_index.add(image_id, *tags)
+                if self.dedup_index is not None:
+                    self.dedup_index.add(image_id, sha256=i["sha256"], dhash=i["dhash"])
+                if self.feed is not None:
+                    self.feed.add(ImageRecord.from_record(i))
+
+    def _images_deleted(self, *image_ids: int, unlinked: Iterable[Tuple[int, str]]=()):
+        unlinked = list(unlinked)
+        super()._images_deleted(*image_ids, unlinked=unlinked)
+        self._discard_images(image_ids, [t for _, t in unlinked])
+
+    def _discard_images(self, image_ids: Iterable[int], tags: Iterable[str]=()):
+        """Remove deleted images from the loaded indexes.
+
+        :param image_ids: IDs of the deleted images.
+        :param tags: The tags that were on them, once per image.
+        """
+        if self.tag_autocomplete is not None:
+            self.tag_autocomplete.remove(*tags)
+        if self.tag_index is not None:
+            self.tag_index.discard_images(*image_ids)
+        if self.dedup_index is not None:
+            self.dedup_index.remove(*image_ids)
+        if self.feed is not None:
+            self.feed.remove(*image_ids)
+
+    def _resync(self):
+        super()._resync()
+        # Changes may have been missed, so the loaded indexes are rebuilt
+        for index, load in ((self.tag_index, self.load_tag_index),
+                            (self.tag_autocomplete, self.load_tag_autocomplete),
+                            (self.dedup_index, self.load_dedup_index),
+                            (self.feed, lambda: self.load_feed(self.feed.size))):
+            if index is not None:
+                self.loop.create_task(load())
+
     async def get_image(self, image_id: int) -> Image:
         """Retrieve an image from the database.
 
@@ -43,8 +668,17 @@ class ImageDB(BaseDatabase):
 
         :return: The :class:`pantsuBooru.models.Image` fetched.
         """
+        image = self.image_cache.get(image_id)
+        if image is not None:
+            return image
+
+        # Not cached if it is changed while being fetched
+        token = self.image_cache.token()
         async with self.db.get_session() as s:
-            return await s.select(Image).where(Image.id == image_id).first()
+            image = await s.select(Image).where(Image.id == image_id).first()
+
+        self.image_cache.set(image_id, image, token)
+        return image
 
     async def get_many_images(self, *image_ids: int) -> [Image]:
         """Retrieve images given a list of image IDs.
@@ -54,11 +688,150 @@ class ImageDB(BaseDatabase):
 
         :return: A list of :class:`pantsuBooru.models.Image`.
         """
+        images = {}
+        for i in image_ids:
+            image = self.image_cache.get(i)
+            if image is not None:
+                images[i] = image
+
+        missing = [i for i in image_ids if i not in images]
+        if missing:
+            token = self.image_cache.token()
+            async with self.db.get_session() as s:
+                fetched = await s.select(Image).where(
+                    Image.id.in_(*missing)).all()
+                fetched = await fetched.flatten()
+
+            for i in fetched:
+                self.image_cache.set(i.id, i, token)
+                images[i.id] = i
+
+        return [images[i] for i in image_ids if i in images]
+
+    async def get_image_tags(self, *image_ids: int) -> Dict[int, List[str]]:
+        """Retrieve the tags of many images in one query.
+
+        :param image_ids: IDs of the images.
+
+        :return: Dict of image ID to its tags, in the order they were added.
+        """
+        tags = {i: [] for i in image_ids}
+        if not tags:
+            return tags
+
+        query = """SELECT "imagetag"."image_id",
+                          ARRAY_AGG("tag"."tag" ORDER BY "imagetag"."id") AS "tags"
+        FROM "imagetag"
+        JOIN "tag" ON "tag"."id" = "imagetag"."tag_id"
+        WHERE "imagetag"."image_id" = ANY($1::integer[])
+        GROUP BY "imagetag"."image_id"
+        """
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, {"$1": list(tags)})
+            async with q as c:
+                async for i in c:
+                    tags[i["image_id"]] = list(i["tags"])
+
+        return tags
+
+    async def get_comments(self, *image_ids: int) -> Dict[int, List[Comment]]:
+        """Retrieve all the comments of many images in one query.
+
+        :param image_ids: IDs of the images.
+
+        :return: Dict of image ID to its :class:`pantsuBooru.models.Comment`, oldest first.
+        """
+        comments = {i: [] for i in image_ids}
+        if not comments:
+            return comments
+
+        async with self.db.get_session() as s:
+            q = await s.cursor("""SELECT * FROM "comment"
+                                  WHERE "comment"."image_id" = ANY($1::integer[])
+                                  ORDER BY "comment"."id" ASC""",
+                               {"$1": list(comments)})
+            async with q as c:
+                async for i in c:
+                    comments[i["image_id"]].append(row_from_record(Comment, i))
+
+        return comments
+
+    async def get_image_comments(self, image_id: int, *, limit: int=100,
+                                 after: int=None) -> [Comment]:
+        """Retrieve a page of the comments on an image.
+
+        :param image_id: ID of the image.
+        :param limit: Limit of comments to return.
+        :param after: Only return comments with an ID higher than this.
+
+        :return: List of :class:`pantsuBooru.models.Comment`, oldest first.
+        """
+        query = """SELECT * FROM "comment"
+        WHERE "comment"."image_id" = $1
+              AND ($2::integer IS NULL OR "comment"."id" > $2::integer)
+        ORDER BY "comment"."id"
+        LIMIT $3
+        """
+
         async with self.db.get_session() as s:
-            images = await s.select(Image).where(
-                Image.id.in_(*image_ids)).all()
-            images = await images.flatten()
-            return sorted(images, key=lambda x: image_ids.index(x.id))
+            q = await s.cursor(query, {"$1": image_id, "$2": after, "$3": limit})
+            async with q as c:
+                return [row_from_record(Comment, i) async for i in c]
+
+    async def get_user_images(self, user_id: int, *, limit: int=100,
+                              before: int=None) -> [Image]:
+        """Retrieve a page of the images posted by a user.
+
+        :param user_id: ID of the user.
+        :param limit: Limit of images to return, None for all of them.
+        :param before: Only return images with an ID lower than this.
+
+        :return: List of :class:`pantsuBooru.models.Image`, newest first.
+        """
+        query = f"""SELECT {IMAGE_COLUMNS}
+        FROM "image"
+        WHERE "image"."poster" = $1
+              AND ($2::integer IS NULL OR "image"."id" < $2::integer)
+        ORDER BY "image"."id" DESC
+        LIMIT $3
+        """
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, {"$1": user_id, "$2": before, "$3": limit})
+            async with q as c:
+                return [row_from_record(Image, i) async for i in c]
+
+    async def get_user_image_ids(self, user_id: int) -> [int]:
+        """Retrieve the IDs of every image posted by a user."""
+        async with self.db.get_session() as s:
+            q = await s.cursor("""SELECT "image"."id" FROM "image"
+                                  WHERE "image"."poster" = $1""",
+                               {"$1": user_id})
+            async with q as c:
+                return [i["id"] async for i in c]
+
+    async def get_user_comments(self, user_id: int, *, limit: int=100,
+                                before: int=None) -> [Comment]:
+        """Retrieve a page of the comments posted by a user.
+
+        :param user_id: ID of the user.
+        :param limit: Limit of comments to return, None for all of them.
+        :param before: Only return comments with an ID lower than this.
+
+        :return: List of :class:`pantsuBooru.models.Comment`, newest first.
+        """
+        query = """SELECT * FROM "comment"
+        WHERE "comment"."poster" = $1
+              AND ($2::integer IS NULL OR "comment"."id" < $2::integer)
+        ORDER BY "comment"."id" DESC
+        LIMIT $3
+        """
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, {"$1": user_id, "$2": before, "$3": limit})
+            async with q as c:
+                return [row_from_record(Comment, i) async for i in c]
 
     async def delete_image(self, image_id: int) -> Image:
         """Delete an image.
@@ -66,7 +839,21 @@ class ImageDB(BaseDatabase):
         :param image_id: ID of image to delete.
         """
         async with self.db.get_session() as s:
-            return await s.remove(Image(id=image_id))
+            # Unlinked before the cascade, so orphaned tags are handled
+            unlinked = await self._unlink_tags(s, [image_id])
+            record = await s.fetch(f"""DELETE FROM "image"
+                                       WHERE "image"."id" = $1
+                                       RETURNING {IMAGE_COLUMNS}""",
+                                   {"$1": image_id})
+
+        self._images_deleted(image_id, unlinked=unlinked)
+
+        if record is None:
+            return None
+
+        image = row_from_record(Image, record)
+        self.evict_users(image.poster_id)
+        return image
 
     async def insert_tags(self, image_id, *tags: str):
         """Insert tags onto an image.
@@ -75,32 +862,207 @@ class ImageDB(BaseDatabase):
 
         :param image_id: ID of image to add tags to.
         :param tags: Tags to add to image.
+
+        :raises TagExists: If the image already had one of the tags.
         """
         tags = list(map(str.lower, tags))
 
-        async with self.db.get_session() as s:
-            q = s.select(Tag).where(Tag.tag.in_(*tags))
-            existing_tags = await (await q.all()).flatten()
-            # Tags that already exist in the db
-            to_create = set(tags) - set(i.tag for i in existing_tags)
-            # Tags that dont exist and need to be created
+        # An image with no tags is still indexed, so queries excluding tags match it
+        if tags:
+            try:
+                async with self.db.get_session() as s:
+                    q = s.select(Tag).where(Tag.tag.in_(*tags))
+                    existing_tags = await (await q.all()).flatten()
+                    # Tags that already exist in the db
+                    to_create = set(tags) - set(i.tag for i in existing_tags)
+                    # Tags that dont exist and need to be created
 
-            created = await s.insert.rows(*(Tag(tag=i)
-                                            for i in to_create)).run()
+                    created = await s.insert.rows(*(Tag(tag=i)
+                                                    for i in to_create)).run()
 
-            tags = existing_tags + created
+                    tags = existing_tags + created
 
-            await s.insert.rows(*(ImageTag(tag_id=i.id, image_id=image_id)
-                                  for i in tags))
+                    await s.insert.rows(*(ImageTag(tag_id=i.id, image_id=image_id)
+                                          for i in tags))
+            except IntegrityError as e:
+                # The unique index added by migration 11
+                if getattr(e.__cause__, "constraint_name", None) == "imagetag_tag_image_idx":
+                    raise TagExists from None
+                raise
 
-    async def replace_tags(self, image_id: int, *tags: str):
+        self.evict_images(image_id)
+        self.publish("image_changed", image_id)
+        self.publish("tag", *(i.id for i in tags))
+        if self.tag_index is not None:
+            self.tag_index.add(image_id, *(i.tag for i in tags))
+        if self.tag_autocomplete is not None:
+            self.tag_autocomplete.add(*(i.tag for i in tags))
+        if self.feed is not None:
+            self.feed.replace(image_id, tags=tuple(unique_tags(i.tag for i in tags)))
+
+    async def replace_tags(self, image_id: int, *tags: str) -> [str]:
         """Replace the tags on an image.
 
+        Only the tags that differ from the current ones are written.
+
         :param image_id: ID of image to add tags to.
         :param tags: Iterable of strings to add.
+
+        :return: The tags now on the image.
+        """
+        return await self.edit_tags(image_id, lambda current: unique_tags(tags))
+
+    async def add_tags(self, image_id: int, *tags: str) -> [str]:
+        """Add tags to an image, ignoring ones it already has.
+
+        :param image_id: ID of image to add tags to.
+        :param tags: Tags to add.
+
+        :return: The tags now on the image.
+        """
+        return await self.edit_tags(image_id,
+                                    lambda current: unique_tags(current + list(tags)))
+
+    async def remove_tags(self, image_id: int, *tags: str) -> [str]:
+        """Remove tags from an image, ignoring ones it doesn't have.
+
+        :param image_id: ID of image to remove tags from.
+        :param tags: Tags to remove.
+
+        :return: The tags now on the image.
         """
-        await self.delete_all_tags(image_id)
-        return await self.insert_tags(image_id, *tags)
+        removed = set(map(str.lower, tags))
+        return await self.edit_tags(image_id,
+                                    lambda current: [i for i in current if i not in removed])
+
+    async def edit_tags(self, image_id: int, edit: Callable[[List[str]], List[str]]) -> [str]:
+        """Change the tags of an image, writing only the links that changed.
+
+        The image is locked while the tags are read and written,
+        so concurrent edits of the same image don't interleave.
+        In write behind mode the edit is queued, unless inside a transaction,
+        see :meth:`start_write_behind`.
+
+        :param image_id: ID of the image to edit.
+        :param edit: Function given the current tags, returning the new tags.
+
+        :raises NoImage: If the image does not exist.
+
+        :return: The tags now on the image, None if queued without durable writes.
+        """
+        if self._tag_writes is not None and not isinstance(self.db, BoundInterface):
+            written = await self._tag_writes.put((image_id, edit))
+            return None if written is None else await written
+
+        [tags] = await self._apply_tag_edits([(image_id, edit)])
+        if isinstance(tags, Exception):
+            raise tags
+        return tags
+
+    async def _apply_tag_edits(self, edits: List[Tuple[int, Callable[[List[str]], List[str]]]]) -> list:
+        """Apply tag edits of many images in one transaction, with a statement per kind of write.
+
+        Edits of the same image are applied in order, each given the tags the last one returned.
+
+        :return: The tags each edit left on its image, or :class:`NoImage` if it does not exist.
+        """
+        image_ids = sorted({i for i, _ in edits})
+
+        async with self.db.get_session() as s:
+            # Locked in ID order, so batches touching the same images can't deadlock
+            q = await s.cursor("""SELECT "id" FROM "image" WHERE "id" = ANY($1::integer[])
+                                  ORDER BY "id" FOR UPDATE""",
+                               {"$1": image_ids})
+            async with q as c:
+                current = {i["id"]: {} async for i in c}
+
+            q = await s.cursor("""
+                SELECT "imagetag"."image_id", "tag"."id", "tag"."tag"
+                FROM "imagetag"
+                JOIN "tag" ON "tag"."id" = "imagetag"."tag_id"
+                WHERE "imagetag"."image_id" = ANY($1::integer[])
+                ORDER BY "imagetag"."id"
+            """, {"$1": list(current)})
+            async with q as c:
+                async for i in c:
+                    current[i["image_id"]][i["tag"]] = i["id"]
+
+            tags = {i: list(tags) for i, tags in current.items()}
+            results = []
+            for image_id, edit in edits:
+                if image_id not in current:
+                    results.append(NoImage())
+                    continue
+                tags[image_id] = edit(tags[image_id])
+                results.append(tags[image_id])
+
+            added = {i: [t for t in tags[i] if t not in current[i]] for i in current}
+            removed = {i: [t for t in current[i] if t not in set(tags[i])] for i in current}
+
+            new = list(dict.fromkeys(t for i in added.values() for t in i))
+            tag_ids = {}
+            if new:
+                tag_ids = await self._resolve_tag_ids(s, new)
+                links = [(tag_ids[t], i) for i in added for t in added[i]]
+                await s.execute("""
+                    INSERT INTO "imagetag" ("tag_id", "image_id")
+                    SELECT * FROM unnest($1::integer[], $2::integer[])
+                """, {"$1": [t for t, _ in links], "$2": [i for _, i in links]})
+
+            removed_ids = [current[i][t] for i in removed for t in removed[i]]
+            if removed_ids:
+                links = [(current[i][t], i) for i in removed for t in removed[i]]
+                await s.execute("""
+                    DELETE FROM "imagetag"
+                    USING unnest($1::integer[], $2::integer[]) AS "removed" ("tag_id", "image_id")
+                    WHERE "imagetag"."image_id" = "removed"."image_id"
+                        AND "imagetag"."tag_id" = "removed"."tag_id"
+                """, {"$1": [t for t, _ in links], "$2": [i for _, i in links]})
+
+                if self._tag_gc is None:
+                    await s.execute("""
+                        DELETE FROM "tag"
+                        WHERE "tag"."id" = ANY($1::integer[])
+                            AND NOT EXISTS (SELECT 1 from "imagetag"
+                                            WHERE "imagetag"."tag_id" = "tag"."id")
+                    """, {"$1": list(set(removed_ids))})
+
+        if removed_ids and self._tag_gc is not None:
+            self._after_commit(functools.partial(self.orphan_tags.update, removed_ids))
+
+        self.evict_images(*current)
+        self.publish("image_changed", *current)
+        self.publish("tag", *tag_ids.values(), *removed_ids)
+        for i in current:
+            if self.tag_index is not None:
+                self.tag_index.add(i, *added[i])
+                self.tag_index.remove(i, *removed[i])
+            if self.tag_autocomplete is not None:
+                self.tag_autocomplete.add(*added[i])
+                self.tag_autocomplete.remove(*removed[i])
+            if self.feed is not None:
+                self.feed.replace(i, tags=tuple(tags[i]))
+
+        return results
+
+    async def _resolve_tag_ids(self, s, tags: List[str]) -> dict:
+        """Get the IDs of tags inside a session, creating the ones that don't exist.
+
+        :param s: The session to use.
+        :param tags: The tags to resolve.
+
+        :return: Dict of {tag: id}.
+        """
+        await s.execute("""
+            INSERT INTO "tag" ("tag")
+            SELECT unnest($1::text[])
+            ON CONFLICT ("tag") DO NOTHING
+        """, {"$1": tags})
+
+        q = await s.cursor("""SELECT "id", "tag" FROM "tag" WHERE "tag" = ANY($1::text[])""",
+                           {"$1": tags})
+        async with q as c:
+            return {i["tag"]: i["id"] async for i in c}
 
     async def delete_all_tags(self, *image_ids: int):
         """Delete all the tags on an image.
@@ -108,13 +1070,165 @@ class ImageDB(BaseDatabase):
         :param image_ids: IDs of the images to remove tags of.
         """
         async with self.db.get_session() as s:
-            await s.delete(ImageTag).where(
-                ImageTag.image_id.in_(*image_ids)).run()
-            await s.execute("""
+            unlinked = await self._unlink_tags(s, image_ids)
+
+        self.evict_images(*image_ids)
+        self.publish("image_changed", *image_ids)
+        self.publish("tag", *{i for i, _ in unlinked})
+        if self.tag_index is not None:
+            self.tag_index.clear_tags(*image_ids)
+        if self.tag_autocomplete is not None:
+            self.tag_autocomplete.remove(*(t for _, t in unlinked))
+        if self.feed is not None:
+            for i in image_ids:
+                self.feed.replace(i, tags=())
+
+    async def _unlink_tags(self, s, image_ids: Iterable[int]) -> [(int, str)]:
+        """Delete every tag link of images inside a session, handling the orphaned tags.
+
+        :return: The (id, tag) of the tags unlinked, once per link.
+        """
+        if self._tag_gc is not None:
+            # Orphans are left for the tag gc to sweep
+            query = """
+                DELETE FROM "imagetag"
+                USING "tag"
+                WHERE "imagetag"."image_id" = ANY($1::integer[])
+                    AND "tag"."id" = "imagetag"."tag_id"
+                RETURNING "tag"."id", "tag"."tag"
+            """
+        else:
+            # Only the unlinked tags are checked for being orphaned.
+            # Both deletes see the same snapshot, so links being removed are excluded
+            query = """
+                WITH "unlinked" AS (
+                    DELETE FROM "imagetag"
+                    USING "tag"
+                    WHERE "imagetag"."image_id" = ANY($1::integer[])
+                        AND "tag"."id" = "imagetag"."tag_id"
+                    RETURNING "tag"."id", "tag"."tag"
+                ), "orphaned" AS (
+                    DELETE FROM "tag"
+                    WHERE "tag"."id" IN (SELECT "id" FROM "unlinked")
+                        AND NOT EXISTS (SELECT 1 FROM "imagetag"
+                                        WHERE "imagetag"."tag_id" = "tag"."id"
+                                            AND "imagetag"."image_id" <> ALL($1::integer[]))
+                )
+                SELECT "id", "tag" FROM "unlinked"
+            """
+
+        q = await s.cursor(query, {"$1": list(image_ids)})
+        async with q as c:
+            unlinked = [(i["id"], i["tag"]) async for i in c]
+
+        if self._tag_gc is not None:
+            self._after_commit(functools.partial(self.orphan_tags.update,
+                                                 [i for i, _ in unlinked]))
+        return unlinked
+
+    def start_tag_gc(self, interval: float=60):
+        """Defer orphan tag cleanup, sweeping unlinked tags on a schedule.
+
+        :param interval: Seconds between sweeps.
+        """
+        if self._tag_gc is None:
+            self._tag_gc = self.loop.create_task(self._run_tag_gc(interval))
+
+    async def stop_tag_gc(self):
+        """Stop the scheduled tag gc, sweeping any pending orphans."""
+        task, self._tag_gc = self._tag_gc, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.sweep_orphan_tags()
+
+    async def _run_tag_gc(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep_orphan_tags()
+            except Exception:
+                log.exception("Sweeping orphaned tags failed")
+
+    def start_write_behind(self, *,
+                           max_batch: int=500,
+                           max_delay: float=0.01,
+                           max_pending: int=10000,
+                           durable: bool=True):
+        """Queue comment inserts and tag edits, writing them in batches of multi-row statements.
+
+        :param max_batch: The most writes of a kind in one statement.
+        :param max_delay: Seconds a write waits for others to join its batch.
+        :param max_pending: The most writes of a kind queued, callers wait for room past it.
+        :param durable: If True, calls return once their write is committed, raising if it failed.
+            If False, they return once queued and failures are only logged,
+            writes still queued are lost if the process dies.
+        """
+        if self._comment_writes is None:
+            options = dict(max_batch=max_batch, max_delay=max_delay, max_pending=max_pending,
+                           durable=durable, loop=self.loop)
+            self._comment_writes = WriteQueue(self._insert_comments, **options)
+            self._tag_writes = WriteQueue(self._apply_tag_edits, **options)
+
+    async def flush_writes(self):
+        """Wait until every write queued so far is committed."""
+        for i in (self._comment_writes, self._tag_writes):
+            if i is not None:
+                await i.flush()
+
+    async def stop_write_behind(self):
+        """Write everything queued and go back to writing immediately."""
+        queues = (self._comment_writes, self._tag_writes)
+        self._comment_writes = self._tag_writes = None
+        for i in queues:
+            if i is not None:
+                await i.close()
+
+    async def sweep_orphan_tags(self, full: bool=False) -> int:
+        """Delete tags that are no longer on any image.
+
+        :param full: Check every tag, rather than only ones unlinked since the last sweep.
+
+        :return: The amount of tags deleted.
+        """
+        if full:
+            self.orphan_tags.clear()
+            query = """
                 DELETE FROM "tag"
                 WHERE NOT EXISTS (SELECT 1 from "imagetag"
-                                  WHERE "imagetag"."tag_id" = "tag"."id");""")
-            # run cleanup on tags that dont have any matched images
+                                  WHERE "imagetag"."tag_id" = "tag"."id")
+                RETURNING "tag"."id"
+            """
+            params = None
+        else:
+            if not self.orphan_tags:
+                return 0
+            # Taken in place, the set is shared with transaction copies of this object
+            candidates = set(self.orphan_tags)
+            self.orphan_tags -= candidates
+            query = """
+                DELETE FROM "tag"
+                WHERE "tag"."id" = ANY($1::integer[])
+                    AND NOT EXISTS (SELECT 1 from "imagetag"
+                                    WHERE "imagetag"."tag_id" = "tag"."id")
+                RETURNING "tag"."id"
+            """
+            params = {"$1": list(candidates)}
+
+        try:
+            async with self.db.get_session() as s:
+                q = await s.cursor(query, params)
+                async with q as c:
+                    deleted = [i["id"] async for i in c]
+        except Exception:
+            if not full:
+                self.orphan_tags |= candidates
+            raise
+
+        return len(deleted)
 
     async def add_comment(self, image_id: int, user_id: int,
                           comment: str) -> Comment:
@@ -124,13 +1238,52 @@ class ImageDB(BaseDatabase):
         :param user: ID of the user that added the comment.
         :param comment: The comment string.
 
-        :return: The comment that was added.
+        :return: The comment that was added. In write behind mode without durable writes,
+            it is returned once queued, without an ID.
+        """
+        comment = Comment(image_id=image_id, poster=user_id, text=comment)
+        # Inside a transaction, writes go to its connection
+        if self._comment_writes is not None and not isinstance(self.db, BoundInterface):
+            written = await self._comment_writes.put(comment)
+            return comment if written is None else await written
+
+        [comment] = await self._insert_comments([comment])
+        return comment
+
+    async def _insert_comments(self, comments: List[Comment]) -> [Comment]:
+        """Insert many comments with one statement.
+
+        :return: The comments inserted, with their IDs.
+        """
+        # The IDs are drawn before inserting, so they can be returned in order
+        query = """
+            WITH "new" AS (
+                SELECT nextval(pg_get_serial_sequence('comment', 'id')) AS "id", "n"
+                FROM generate_series(1, $1::integer) AS "n"
+            ), "inserted" AS (
+                INSERT INTO "comment" ("id", "image_id", "poster", "text")
+                SELECT "new"."id", "row"."image_id", "row"."poster", "row"."text"
+                FROM "new"
+                JOIN unnest($2::integer[], $3::integer[], $4::text[])
+                    WITH ORDINALITY AS "row" ("image_id", "poster", "text", "n")
+                    ON "row"."n" = "new"."n"
+            )
+            SELECT "id" FROM "new" ORDER BY "n"
         """
+
         async with self.db.get_session() as s:
-            comment = Comment(image_id=image_id, poster=user_id, text=comment)
-            q = s.insert.add_row(comment)
-            [comment] = await q.run()
-            return comment
+            q = await s.cursor(query, {"$1": len(comments),
+                                       "$2": [i.image_id for i in comments],
+                                       "$3": [i.poster for i in comments],
+                                       "$4": [i.text for i in comments]})
+            async with q as c:
+                ids = [i["id"] async for i in c]
+
+        self.evict_images(*{i.image_id for i in comments})
+        self.evict_users(*{i.poster for i in comments})
+        return [row_from_record(Comment, {"id": comment_id, "image_id": i.image_id,
+                                          "poster": i.poster, "text": i.text})
+                for comment_id, i in zip(ids, comments)]
 
     async def delete_comment(self, comment_id: int) -> Comment:
         """Delete a comment.
@@ -140,37 +1293,456 @@ class ImageDB(BaseDatabase):
         :return: The :class:`pantsuBooru.models.Comment` that was deleted.
         """
         async with self.db.get_session() as s:
-            return await s.remove(Comment(id=comment_id))
+            record = await s.fetch("""DELETE FROM "comment"
+                                      WHERE "comment"."id" = $1
+                                      RETURNING *""",
+                                   {"$1": comment_id})
+
+        if record is None:
+            return None
+
+        comment = row_from_record(Comment, record)
+        self.evict_images(comment.image_id)
+        self.evict_users(comment.poster)
+        return comment
+
+    async def search_comments(self, query: str, *, limit: int=50,
+                              after: Tuple[float, int]=None) -> [CommentResult]:
+        """Full text search of comments, best matches first.
+
+        :param query: The search, in web search syntax: words, "quoted phrases", OR and -excluded.
+        :param limit: Limit of comments to return.
+        :param after: The :attr:`CommentResult.cursor` of the last result of the previous page.
+
+        :return: List of :class:`CommentResult`.
+        """
+        rank, last_id = after or (None, None)
+
+        sql = """SELECT * FROM (
+            SELECT "comment".*,
+                   ts_rank_cd(to_tsvector('english', coalesce("comment"."text", '')),
+                              "query") AS "rank"
+            FROM "comment", websearch_to_tsquery('english', $1) AS "query"
+            WHERE to_tsvector('english', coalesce("comment"."text", '')) @@ "query"
+        ) AS "matched"
+        WHERE $2::real IS NULL OR ("matched"."rank", "matched"."id") < ($2::real, $3::integer)
+        ORDER BY "matched"."rank" DESC, "matched"."id" DESC
+        LIMIT $4
+        """
 
-    async def search_tags(self, *tags: str, limit=100) -> [Image]:
+        params = {"$1": query, "$2": rank, "$3": last_id, "$4": limit}
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(sql, params)
+            async with q as c:
+                return [CommentResult(row_from_record(Comment, i), i["rank"]) async for i in c]
+
+    async def search_images_text(self, text: str, *,
+                                 fields: Iterable[str]=("author", "source"),
+                                 limit: int=50) -> [Image]:
+        """Find images whose author or source contains some text, closest matches first.
+
+        Matching is case insensitive and uses the trigram indexes.
+
+        :param text: The text to search for.
+        :param fields: Which of "author" and "source" to search.
+        :param limit: Limit of images to return.
+
+        :return: List of :class:`pantsuBooru.models.Image`.
+        """
+        fields = [i for i in TEXT_FIELDS if i in fields]
+        if not fields or not text:
+            return []
+
+        # LIKE wildcards in the text are matched literally
+        pattern = "%" + re.sub(r"([\\%_])", r"\\\1", text) + "%"
+        matches = " OR ".join(f'"image"."{i}" ILIKE $1' for i in fields)
+        similarity = ", ".join(f'similarity(coalesce("image"."{i}", \'\'), $2)' for i in fields)
+
+        sql = f"""SELECT {IMAGE_COLUMNS}
+        FROM "image"
+        WHERE {matches}
+        ORDER BY GREATEST({similarity}, 0) DESC, "image"."id" DESC
+        LIMIT $3
+        """
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(sql, {"$1": pattern, "$2": text, "$3": limit})
+            async with q as c:
+                return [row_from_record(Image, i) async for i in c]
+
+    async def search_tags(self, *tags: str, limit=100,
+                          after: Tuple[int, int]=None) -> [Image]:
         """Search images by tags.
 
         :param tags: Tags to search for.
         :param limit: Limit of images to return.
+        :param after: Keyset cursor of the last result of the previous page.
 
         :return: List of :class:`pantsuBooru.models.Image` ordered by most matching tags.
         """
+        results = await self.search_tags_ranked(*tags, limit=limit, after=after)
+        return [i.image for i in results]
+
+    async def search_tags_ranked(self, *tags: str, limit=100,
+                                 after: Tuple[int, int]=None) -> [SearchResult]:
+        """Search images by tags, fetching their tags and posters in the same query.
+
+        Pages are fetched by keyset, so deep pages cost the same as the first.
+        If the tag index is loaded, the ranking is done in memory.
+
+        :param tags: Tags to search for.
+        :param limit: Limit of images to return.
+        :param after: The :attr:`SearchResult.cursor` of the last result of the previous page.
+
+        :return: List of :class:`SearchResult` ordered by most matching tags.
+        """
+        ranked = await self._search_ranked(tags, limit, after)
+        return [result_from_record(i, matches) for i, matches in ranked]
+
+    async def search_records(self, *tags: str, limit=100,
+                             after: Tuple[int, int]=None) -> [ImageRecord]:
+        """Search images by tags like :meth:`search_tags_ranked`, returning read only records.
+
+        :param tags: Tags to search for.
+        :param limit: Limit of images to return.
+        :param after: The :attr:`ImageRecord.cursor` of the last result of the previous page.
+
+        :return: List of :class:`ImageRecord` ordered by most matching tags.
+        """
+        ranked = await self._search_ranked(tags, limit, after)
+        return [ImageRecord.from_record(i, matches) for i, matches in ranked]
+
+    async def _search_ranked(self, tags: Iterable[str], limit: int,
+                             after: Optional[Tuple[int, int]]) -> [Tuple[dict, int]]:
+        if self.tag_index is not None:
+            ranked = self.tag_index.rank(*tags, limit=limit, after=after)
+            return await self._fetch_ranked(ranked)
+
         tags = list(map(str.lower, tags))
+        matches, last_id = after or (None, None)
+
+        query = f"""WITH "matched" AS (
+            SELECT "imagetag"."image_id" AS "id", COUNT(*) AS "matches"
+            FROM "imagetag"
+            JOIN "tag" ON "tag"."id" = "imagetag"."tag_id"
+            WHERE "tag"."tag" = ANY($1::text[])
+            GROUP BY "imagetag"."image_id"
+        )
+        SELECT {RESULT_COLUMNS}, "matched"."matches"
+        FROM "matched"
+        JOIN "image" ON "image"."id" = "matched"."id"
+        LEFT JOIN "user" ON "user"."id" = "image"."poster"
+        WHERE $2::bigint IS NULL
+              OR ("matched"."matches", "image"."id") < ($2::bigint, $3::integer)
+        ORDER BY "matched"."matches" DESC, "image"."id" DESC
+        LIMIT $4
+        """
+
+        params = {"$1": tags, "$2": matches, "$3": last_id, "$4": limit}
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, params)
+            async with q as c:
+                return [(i, i["matches"]) async for i in c]
+
+    async def get_search_results(self, ranked: Iterable[Tuple[int, int]]) -> [SearchResult]:
+        """Fetch the rows of already ranked search results.
+
+        :param ranked: Iterable of (image_id, matches) in the order to return.
+
+        :return: List of :class:`SearchResult` in the same order.
+        """
+        return [result_from_record(i, matches)
+                for i, matches in await self._fetch_ranked(ranked)]
+
+    async def _fetch_ranked(self, ranked: Iterable[Tuple[int, int]]) -> [Tuple[dict, int]]:
+        ranked = list(ranked)
+        if not ranked:
+            return []
+
+        query = f"""SELECT {RESULT_COLUMNS}
+        FROM "image"
+        LEFT JOIN "user" ON "user"."id" = "image"."poster"
+        WHERE "image"."id" = ANY($1::integer[])
+        """
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, {"$1": [i for i, _ in ranked]})
+            async with q as c:
+                records = {i["id"]: i async for i in c}
+
+        return [(records[i], matches) for i, matches in ranked if i in records]
+
+    async def get_user_image_records(self, user_id: int, *, limit: int=100,
+                                     before: int=None) -> [ImageRecord]:
+        """Retrieve a page of the images posted by a user as read only records.
+
+        :param user_id: ID of the user.
+        :param limit: Limit of images to return.
+        :param before: Only return images with an ID lower than this.
+
+        :return: List of :class:`ImageRecord`, newest first.
+        """
+        query = f"""SELECT {RESULT_COLUMNS}
+        FROM "image"
+        LEFT JOIN "user" ON "user"."id" = "image"."poster"
+        WHERE "image"."poster" = $1
+              AND ($2::integer IS NULL OR "image"."id" < $2::integer)
+        ORDER BY "image"."id" DESC
+        LIMIT $3
+        """
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, {"$1": user_id, "$2": before, "$3": limit})
+            async with q as c:
+                return [ImageRecord.from_record(i) async for i in c]
+
+    #: The ring buffer of the newest images, if it has been loaded.
+    feed = None  # type: Optional[FeedBuffer]
+
+    async def load_feed(self, size: int=500) -> FeedBuffer:
+        """Fill the ring buffer of the newest images from the database.
+
+        Once loaded, the first pages of :meth:`get_feed` and :meth:`get_user_feed`
+        are answered from it, and images added, deleted or retagged through this object
+        keep it up to date.
+
+        :param size: Most images held.
+
+        :return: The loaded :class:`FeedBuffer`.
+        """
+        records = await self._query_feed(size, None, [], None)
+        feed = FeedBuffer(size)
+        feed.load(records, complete=len(records) < size)
+        self.feed = feed
+        return feed
+
+    async def get_feed(self, *, limit: int=50, before: FeedCursor=None,
+                       tags: Iterable[str]=()) -> [ImageRecord]:
+        """Retrieve a page of the latest posts.
+
+        :param limit: Limit of images to return.
+        :param before: Only return images older than this cursor,
+            the ``(posted_at, id)`` of the last image of the previous page.
+        :param tags: Only return images with all of these tags.
+
+        :return: List of :class:`ImageRecord`, newest first.
+        """
+        return await self._get_feed(limit, before, unique_tags(tags), None)
+
+    async def get_user_feed(self, user_id: int, *, limit: int=50, before: FeedCursor=None,
+                            tags: Iterable[str]=()) -> [ImageRecord]:
+        """Retrieve a page of the images posted by a user, latest first.
+
+        :param user_id: ID of the user.
+        :param limit: Limit of images to return.
+        :param before: Only return images older than this cursor,
+            the ``(posted_at, id)`` of the last image of the previous page.
+        :param tags: Only return images with all of these tags.
+
+        :return: List of :class:`ImageRecord`, newest first.
+        """
+        return await self._get_feed(limit, before, unique_tags(tags), user_id)
+
+    async def _get_feed(self, limit: int, before: Optional[FeedCursor], tags: List[str],
+                        user_id: Optional[int]) -> [ImageRecord]:
+        if self.feed is not None:
+            def predicate(record: ImageRecord) -> bool:
+                return ((user_id is None or record.poster_id == user_id)
+                        and all(i in record.tags for i in tags))
+
+            page = self.feed.page(limit, before, predicate)
+            if page is not None:
+                return await self._fill_posters(page)
+
+        return await self._query_feed(limit, before, tags, user_id)
+
+    async def _query_feed(self, limit: int, before: Optional[FeedCursor], tags: List[str],
+                          user_id: Optional[int]) -> [ImageRecord]:
+        async with self.db.get_session() as s:
+            where, params = "TRUE", {}
+            if tags:
+                compiled = await self._compile_term(s, AndTerm(tuple(map(TagTerm, tags))))
+                if compiled is None:
+                    return []
+                where, params = compiled
+
+            def param(value) -> str:
+                name = f"${len(params) + 1}"
+                params[name] = value
+                return name
+
+            # Each combination of filters is its own statement, so every one is planned
+            # as a range scan of the feed indexes
+            clauses = [where, '"image"."posted_at" IS NOT NULL']
+            if user_id is not None:
+                clauses.append(f'"image"."poster" = {param(user_id)}')
+            if before is not None:
+                clauses.append(f'("image"."posted_at", "image"."id") < '
+                               f'({param(before[0])}::timestamp, {param(before[1])}::integer)')
+
+            query = f"""SELECT {RESULT_COLUMNS}
+            FROM "image"
+            LEFT JOIN "user" ON "user"."id" = "image"."poster"
+            WHERE {" AND ".join(clauses)}
+            ORDER BY "image"."posted_at" DESC, "image"."id" DESC
+            LIMIT {param(limit)}
+            """
+
+            q = await s.cursor(query, params)
+            async with q as c:
+                return [ImageRecord.from_record(i) async for i in c]
+
+    async def _fill_posters(self, records: List[ImageRecord]) -> [ImageRecord]:
+        """Fill in the posters of feed records added without them, keeping them in the feed."""
+        missing = {i.poster_id for i in records if i.poster is None and i.poster_id is not None}
+        if not missing:
+            return records
+
+        posters = {}
+        for i in missing:
+            user = self.cached_user("id", i)
+            if user is not None:
+                posters[i] = UserRecord(user.id, user.joined_at, user.username)
+
+        if len(posters) < len(missing):
+            async with self.db.get_session() as s:
+                q = await s.cursor("""SELECT "id", "joined_at", "username" FROM "user"
+                                      WHERE "id" = ANY($1::integer[])""",
+                                   {"$1": list(missing - posters.keys())})
+                async with q as c:
+                    async for i in c:
+                        posters[i["id"]] = UserRecord.from_record(i)
+
+        filled = []
+        for i in records:
+            if i.poster is None and i.poster_id in posters:
+                i = i._replace(poster=posters[i.poster_id])
+                if self.feed is not None:
+                    self.feed.replace(i.id, poster=i.poster)
+            filled.append(i)
+        return filled
+
+    async def search_query(self, query: str, *, limit=100, before: int=None) -> [Image]:
+        """Search images with a tag query such as ``cat dog -nsfw (blue_eyes OR green_eyes)``.
+
+        The query is planned with the amount of images of each tag, so intersections
+        start from the rarest tags, then run as a single statement.
+        If the tag index is loaded, it is evaluated in memory instead.
+
+        :param query: The query, see :class:`pantsuBooru.backend.query.Parser`.
+        :param limit: Limit of images to return.
+        :param before: Only return images with an ID lower than this.
+
+        :raises BadQuery: If the query can't be parsed.
+
+        :return: List of :class:`pantsuBooru.models.Image`, newest first.
+        """
+        term = parse_query(query)
+
+        if self.tag_index is not None:
+            index = self.tag_index
+            counts = {i: len(index.bitmap(i)) for i in query_tags(term)}
+            planned = plan(term, counts, len(index.images))
+            ids = index.page(evaluate(planned, index), limit, before)
+            return await self.get_many_images(*ids)
 
         async with self.db.get_session() as s:
-            # Shit
-            tags_v = [f"${i}" for i, _ in enumerate(tags, 1)]
-            tags_fmt = ", ".join(tags_v)
+            compiled = await self._compile_term(s, term)
+            if compiled is None:
+                return []
 
-            query = f"""SELECT "image"."id"
-            FROM "imagetag", "image", "tag"
-            WHERE "imagetag"."tag_id" = "tag"."id"
-                AND ("tag"."tag" IN ({tags_fmt}))
-                AND "image"."id" = "imagetag"."image_id"
-            GROUP BY "image"."id"
-            HAVING COUNT("image"."id") > 0
-            ORDER BY COUNT("image"."id") DESC
-            LIMIT {limit}
+            where, params = compiled
+            before_param, limit_param = f"${len(params) + 1}", f"${len(params) + 2}"
+            params[before_param], params[limit_param] = before, limit
+            sql = f"""SELECT {IMAGE_COLUMNS}
+            FROM "image"
+            WHERE {where}
+                AND ({before_param}::integer IS NULL OR "image"."id" < {before_param}::integer)
+            ORDER BY "image"."id" DESC
+            LIMIT {limit_param}
             """
 
-            q = await s.cursor(query, dict(zip(tags_v, tags)))
+            q = await s.cursor(sql, params)
+            async with q as c:
+                return [row_from_record(Image, i) async for i in c]
+
+    async def _compile_term(self, s, term: Term) -> Optional[Tuple[str, Dict[str, int]]]:
+        """Plan a parsed query with the counts of its tags and compile it, inside a session.
+
+        :return: The WHERE clause on "image" and its parameters,
+            or None if the query matches nothing.
+        """
+        # Exact, a tag counted 0 is planned as matching nothing
+        q = await s.cursor(f"""SELECT "tag"."id", "tag"."tag", {EXACT_COUNT} AS "count"
+                               FROM "tag"
+                               WHERE "tag"."tag" = ANY($1::text[])""",
+                           {"$1": list(query_tags(term))})
+        async with q as c:
+            tags = [i async for i in c]
+
+        planned = plan(term, {i["tag"]: i["count"] for i in tags})
+        if planned == NOTHING:
+            return None
+        return compile_query(planned, {i["tag"]: i["id"] for i in tags})
+
+    async def search_tags_boolean(self,
+                                  *,
+                                  all_of: Iterable[str]=(),
+                                  any_of: Iterable[str]=(),
+                                  none_of: Iterable[str]=(),
+                                  limit=100,
+                                  before: int=None) -> [Image]:
+        """Search images with a boolean tag query.
+
+        :param all_of: Tags that images must all have.
+        :param any_of: Tags that images must have at least one of.
+        :param none_of: Tags that images must not have.
+        :param limit: Limit of images to return.
+        :param before: Only return images with an ID lower than this.
+
+        :return: List of :class:`pantsuBooru.models.Image`, newest first.
+        """
+        all_of, any_of, none_of = (list(map(str.lower, i))
+                                   for i in (all_of, any_of, none_of))
+
+        if self.tag_index is not None:
+            matched = self.tag_index.match(all_of, any_of, none_of)
+            ids = self.tag_index.page(matched, limit, before)
+            results = await self.get_search_results((i, 0) for i in ids)
+            return [i.image for i in results]
+
+        query = f"""SELECT {IMAGE_COLUMNS}
+        FROM "image"
+        WHERE (cardinality($1::text[]) = 0 OR "image"."id" IN (
+                SELECT "imagetag"."image_id"
+                FROM "imagetag"
+                JOIN "tag" ON "tag"."id" = "imagetag"."tag_id"
+                WHERE "tag"."tag" = ANY($1::text[])
+                GROUP BY "imagetag"."image_id"
+                HAVING COUNT(DISTINCT "tag"."id") = cardinality($1::text[])))
+            AND (cardinality($2::text[]) = 0 OR EXISTS (
+                SELECT 1
+                FROM "imagetag"
+                JOIN "tag" ON "tag"."id" = "imagetag"."tag_id"
+                WHERE "imagetag"."image_id" = "image"."id"
+                    AND "tag"."tag" = ANY($2::text[])))
+            AND NOT EXISTS (
+                SELECT 1
+                FROM "imagetag"
+                JOIN "tag" ON "tag"."id" = "imagetag"."tag_id"
+                WHERE "imagetag"."image_id" = "image"."id"
+                    AND "tag"."tag" = ANY($3::text[]))
+            AND ($4::integer IS NULL OR "image"."id" < $4::integer)
+        ORDER BY "image"."id" DESC
+        LIMIT $5
+        """
+
+        params = {"$1": all_of, "$2": any_of, "$3": none_of,
+                  "$4": before, "$5": limit}
+
+        async with self.db.get_session() as s:
+            q = await s.cursor(query, params)
             async with q as c:
-                image_ids = [i.get("id") async for i in c]
-            # TODO: eventually just do this all in the ORM
-            # or atleast only do a single query
-            return await self.get_many_images(*image_ids)
+                return [row_from_record(Image, i) async for i in c]
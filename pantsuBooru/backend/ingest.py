@@ -0,0 +1,160 @@
+import logging
+import time
+from datetime import datetime
+from typing import AsyncIterable, Callable, Iterable, List, NamedTuple, Union
+
+from .image_db import ImageDB
+from .records import ImageRecord
+
+log = logging.getLogger(__name__)
+
+
+class IngestRecord(NamedTuple):
+    """A single image to ingest."""
+
+    author: str
+    source: str
+    poster: int
+    tags: Iterable[str]
+
+
+class IngestProgress(NamedTuple):
+    """Progress of a running bulk ingest."""
+
+    images: int
+    tags_created: int
+    elapsed: float
+
+    @property
+    def rate(self) -> float:
+        """Images ingested per second."""
+        return self.images / self.elapsed if self.elapsed else 0.0
+
+
+Records = Union[Iterable[IngestRecord], AsyncIterable[IngestRecord]]
+
+
+async def batched(records: Records, size: int):
+    """Group a sync or async iterable into lists of at most ``size`` items."""
+    batch = []
+    if hasattr(records, "__aiter__"):
+        async for i in records:
+            batch.append(i)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    else:
+        for i in records:
+            batch.append(i)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class IngestDB(ImageDB):
+    async def bulk_add_images(self,
+                              records: Records,
+                              *,
+                              batch_size: int=5000,
+                              progress: Callable[[IngestProgress], None]=None) -> IngestProgress:
+        """Add many images, writing them with COPY in large batches.
+
+        Each batch is written in its own transaction.
+
+        :param records: Iterable or async iterable of (author, source, poster, tags).
+        :param batch_size: Number of images to write per transaction.
+        :param progress: Called with an :class:`IngestProgress` after every batch.
+
+        :return: The final :class:`IngestProgress`.
+        """
+        tag_ids = {}  # Tags resolved so far, shared across batches
+        images = tags_created = 0
+        start = time.monotonic()
+        stats = IngestProgress(0, 0, 0.0)
+
+        async for batch in batched(records, batch_size):
+            batch = [IngestRecord(author, source, poster, sorted(set(map(str.lower, tags))))
+                     for author, source, poster, tags in batch]
+
+            posted_at = datetime.utcnow()
+            async with self.db.get_session() as s:
+                conn = s.transaction.acquired_connection
+                tags_created += await self._resolve_tags(conn, batch, tag_ids)
+                image_ids = await self._copy_images(conn, batch, tag_ids, posted_at)
+
+            if self.tag_index is not None:
+                for image_id, i in zip(image_ids, batch):
+                    self.tag_index.add(image_id, *i.tags)
+            if self.tag_autocomplete is not None:
+                self.tag_autocomplete.add(*(t for i in batch for t in i.tags))
+            if self.feed is not None:
+                # Only the newest of the batch would be kept
+                for image_id, i in list(zip(image_ids, batch))[-self.feed.size:]:
+                    self.feed.add(ImageRecord(image_id, posted_at, i.author, i.source,
+                                              i.poster, tuple(i.tags), None))
+            self.evict_users(*{i.poster for i in batch})
+            self.publish("image_changed", *image_ids)
+            self.publish("tag", *{tag_ids[t] for i in batch for t in i.tags})
+
+            images += len(batch)
+            stats = IngestProgress(images, tags_created, time.monotonic() - start)
+            log.info("Ingested %d images (%d new tags), %.0f images/s",
+                     stats.images, stats.tags_created, stats.rate)
+            if progress is not None:
+                progress(stats)
+
+        return stats
+
+    async def _resolve_tags(self, conn, batch: List[IngestRecord], tag_ids: dict) -> int:
+        """Create the tags of a batch that don't exist and store all their IDs in ``tag_ids``.
+
+        :return: The amount of tags created.
+        """
+        unknown = list({t for i in batch for t in i.tags} - tag_ids.keys())
+        if not unknown:
+            return 0
+
+        created = await conn.fetch("""
+            INSERT INTO "tag" ("tag")
+            SELECT unnest($1::text[])
+            ON CONFLICT ("tag") DO NOTHING
+            RETURNING "id", "tag"
+        """, unknown)
+        tag_ids.update((i["tag"], i["id"]) for i in created)
+
+        existing = await conn.fetch("""
+            SELECT "id", "tag" FROM "tag" WHERE "tag" = ANY($1::text[])
+        """, [i for i in unknown if i not in tag_ids])
+        tag_ids.update((i["tag"], i["id"]) for i in existing)
+
+        return len(created)
+
+    async def _copy_images(self, conn, batch: List[IngestRecord], tag_ids: dict,
+                           posted_at: datetime) -> List[int]:
+        """COPY the images of a batch and their tags.
+
+        :return: The IDs of the images, in the same order as the batch.
+        """
+        # COPY can't return generated keys, so take the IDs from the sequence first
+        rows = await conn.fetch("""
+            SELECT nextval(pg_get_serial_sequence('image', 'id')) AS "id"
+            FROM generate_series(1, $1)
+        """, len(batch))
+        image_ids = [i["id"] for i in rows]
+
+        await conn.copy_records_to_table(
+            "image",
+            records=[(image_id, posted_at, i.author, i.source, i.poster)
+                     for image_id, i in zip(image_ids, batch)],
+            columns=("id", "posted_at", "author", "source", "poster"))
+
+        await conn.copy_records_to_table(
+            "imagetag",
+            records=[(tag_ids[t], image_id)
+                     for image_id, i in zip(image_ids, batch)
+                     for t in i.tags],
+            columns=("tag_id", "image_id"))
+
+        return image_ids
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Iterable, List, Optional
+
+
+class BatchLoader:
+    """Collects loads made in the same loop iteration and fetches them with a single call.
+
+    :param batch_fn: Coroutine function taking many keys and returning the values found.
+    :param key: Function to get the key of a value returned by ``batch_fn``.
+        If None, ``batch_fn`` returns a mapping of key to value instead.
+    :param max_batch: The most keys to pass to ``batch_fn`` at once.
+    :param loop: The event loop to schedule batches on.
+    """
+
+    def __init__(self,
+                 batch_fn: Callable[..., Awaitable[Iterable[Any]]],
+                 key: Optional[Callable[[Any], Hashable]],
+                 *,
+                 max_batch: int=1000,
+                 loop: asyncio.AbstractEventLoop=None):
+        self.batch_fn = batch_fn
+        self.key = key
+        self.max_batch = max_batch
+        self.loop = loop or asyncio.get_event_loop()
+
+        self._pending = {}
+        self._scheduled = False
+
+    def load(self, key: Hashable) -> 'asyncio.Future':
+        """Load a single value.
+
+        The value resolves to None if ``batch_fn`` did not return it.
+        This function returns a future.
+        """
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = self.loop.create_future()
+            if not self._scheduled:
+                self._scheduled = True
+                self.loop.call_soon(self._dispatch)
+        return future
+
+    async def load_many(self, *keys: Hashable) -> List[Any]:
+        """Load many values, in the same order as the keys."""
+        return await asyncio.gather(*map(self.load, keys))
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        self._scheduled = False
+
+        keys = list(pending)
+        for i in range(0, len(keys), self.max_batch):
+            batch = {k: pending[k] for k in keys[i:i + self.max_batch]}
+            self.loop.create_task(self._run(batch))
+
+    async def _run(self, batch: dict):
+        try:
+            values = await self.batch_fn(*batch)
+        except Exception as e:
+            for i in batch.values():
+                if not i.done():
+                    i.set_exception(e)
+            return
+
+        if self.key is None:
+            found = values
+        else:
+            found = {self.key(i): i for i in values if i is not None}
+        for k, future in batch.items():
+            if not future.done():
+                future.set_result(found.get(k))
@@ -0,0 +1,327 @@
+import functools
+import logging
+import re
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+from asyncqlio.db import DatabaseInterface
+from asyncqlio.orm.session import Session
+
+log = logging.getLogger(__name__)
+
+# Seconds, roughly doubling from 1ms to 10s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Lists of parameters, so IN queries of any length are one statement
+PARAM_LIST = re.compile(r"\$\d+(?:\s*,\s*\$\d+)*")
+WHITESPACE = re.compile(r"\s+")
+# Row count at the end of a command status, such as "UPDATE 3"
+STATUS_ROWS = re.compile(r"(\d+)$")
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapse a statement's whitespace and parameter lists, to group it with its executions."""
+    return PARAM_LIST.sub("$n", WHITESPACE.sub(" ", sql).strip())
+
+
+class MetricEvent(NamedTuple):
+    """A single timed call, passed to the sinks of :class:`Metrics`."""
+
+    #: One of "method", "statement" or "connection".
+    kind: str
+    name: str
+    duration: float
+    rows: Optional[int]
+    error: bool
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, as in prometheus."""
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Sequence[float]=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> List[int]:
+        total = 0
+        counts = []
+        for i in self.counts:
+            total += i
+            counts.append(total)
+        return counts
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics:
+    """Latency histograms of backend methods, SQL statements and connection waits.
+
+    :param slow_query_threshold: Seconds above which statements are logged, None to not log them.
+    :param buckets: Upper bounds of the histogram buckets, in seconds.
+    :param max_statements: Most distinct statements tracked, the rest are counted as "other".
+    :param sinks: Callables passed every :class:`MetricEvent` as it is recorded.
+    """
+
+    def __init__(self, *,
+                 slow_query_threshold: Optional[float]=0.5,
+                 buckets: Sequence[float]=DEFAULT_BUCKETS,
+                 max_statements: int=1000,
+                 sinks: Iterable[Callable[[MetricEvent], None]]=()):
+        self.slow_query_threshold = slow_query_threshold
+        self.buckets = buckets
+        self.max_statements = max_statements
+        self.sinks = list(sinks)
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        self.methods = {}  # type: Dict[str, Histogram]
+        self.method_errors = {}  # type: Dict[str, int]
+        self.statements = {}  # type: Dict[str, Histogram]
+        self.statement_rows = {}  # type: Dict[str, int]
+        self.statement_errors = {}  # type: Dict[str, int]
+        self.connection_wait = Histogram(self.buckets)
+        self.slow_queries = 0
+
+    def add_sink(self, sink: Callable[[MetricEvent], None]):
+        self.sinks.append(sink)
+
+    def _emit(self, event: MetricEvent):
+        for i in self.sinks:
+            try:
+                i(event)
+            except Exception:
+                log.exception("Metric sink %r failed", i)
+
+    def observe_method(self, name: str, duration: float, error: bool=False):
+        histogram = self.methods.get(name)
+        if histogram is None:
+            histogram = self.methods[name] = Histogram(self.buckets)
+        histogram.observe(duration)
+        if error:
+            self.method_errors[name] = self.method_errors.get(name, 0) + 1
+        if self.sinks:
+            self._emit(MetricEvent("method", name, duration, None, error))
+
+    def observe_statement(self, sql: str, duration: float, rows: Optional[int],
+                          error: bool=False):
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            self.slow_queries += 1
+            log.warning("Slow query took %.3fs and returned %s rows: %s",
+                        duration, rows, WHITESPACE.sub(" ", sql).strip())
+
+        key = normalize_sql(sql)
+        histogram = self.statements.get(key)
+        if histogram is None:
+            if len(self.statements) >= self.max_statements:
+                key = "other"
+                histogram = self.statements.get(key)
+            if histogram is None:
+                histogram = self.statements[key] = Histogram(self.buckets)
+        histogram.observe(duration)
+        if rows:
+            self.statement_rows[key] = self.statement_rows.get(key, 0) + rows
+        if error:
+            self.statement_errors[key] = self.statement_errors.get(key, 0) + 1
+        if self.sinks:
+            self._emit(MetricEvent("statement", key, duration, rows, error))
+
+    def observe_connection_wait(self, duration: float):
+        self.connection_wait.observe(duration)
+        if self.sinks:
+            self._emit(MetricEvent("connection", "wait", duration, None, False))
+
+    def to_prometheus(self, prefix: str="pantsubooru") -> str:
+        """Export everything recorded in the prometheus text format."""
+        lines = []
+
+        def histogram(name: str, help: str, label: str, histograms: Dict[str, Histogram]):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for key, h in histograms.items():
+                labels = f'{label}="{escape_label(key)}",' if label else ""
+                for bound, count in zip(h.buckets, h.cumulative()):
+                    lines.append(f'{prefix}_{name}_bucket{{{labels}le="{bound}"}} {count}')
+                lines.append(f'{prefix}_{name}_bucket{{{labels}le="+Inf"}} {h.count}')
+                labels = f'{{{labels[:-1]}}}' if labels else ""
+                lines.append(f"{prefix}_{name}_sum{labels} {h.sum}")
+                lines.append(f"{prefix}_{name}_count{labels} {h.count}")
+
+        def counter(name: str, help: str, label: str, counts: Dict[str, int]):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for key, count in counts.items():
+                lines.append(f'{prefix}_{name}{{{label}="{escape_label(key)}"}} {count}')
+
+        histogram("method_seconds", "Latency of backend methods.", "method", self.methods)
+        counter("method_errors_total", "Backend method calls that raised.",
+                "method", self.method_errors)
+        histogram("statement_seconds", "Latency of SQL statements, including fetching rows.",
+                  "statement", self.statements)
+        counter("statement_rows_total", "Rows returned or affected by SQL statements.",
+                "statement", self.statement_rows)
+        counter("statement_errors_total", "SQL statements that raised.",
+                "statement", self.statement_errors)
+        histogram("connection_wait_seconds", "Time to acquire a connection and begin.",
+                  None, {"": self.connection_wait})
+        lines.append(f"# HELP {prefix}_slow_queries_total Statements over the slow query threshold.")
+        lines.append(f"# TYPE {prefix}_slow_queries_total counter")
+        lines.append(f"{prefix}_slow_queries_total {self.slow_queries}")
+        return "\n".join(lines) + "\n"
+
+
+def timed_method(fn: Callable, metrics: Metrics, name: str) -> Callable:
+    """Wrap a coroutine method to record its latency."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException:
+            metrics.observe_method(name, time.perf_counter() - start, error=True)
+            raise
+        metrics.observe_method(name, time.perf_counter() - start)
+        return result
+
+    return wrapper
+
+
+class TimedResultSet:
+    """Wraps a result set to time the statement until its rows are all fetched."""
+
+    def __init__(self, metrics: Metrics, sql: str, result_set, elapsed: float):
+        self.metrics = metrics
+        self.sql = sql
+        self.result_set = result_set
+        self.elapsed = elapsed
+        self.rows = 0
+        self.recorded = False
+
+    def record(self):
+        if not self.recorded:
+            self.recorded = True
+            self.metrics.observe_statement(self.sql, self.elapsed, self.rows)
+
+    async def fetch_row(self):
+        start = time.perf_counter()
+        row = await self.result_set.fetch_row()
+        self.elapsed += time.perf_counter() - start
+        if row is None:
+            self.record()
+        else:
+            self.rows += 1
+        return row
+
+    async def fetch_many(self, n: int):
+        start = time.perf_counter()
+        rows = await self.result_set.fetch_many(n)
+        self.elapsed += time.perf_counter() - start
+        self.rows += len(rows)
+        if len(rows) < n:
+            self.record()
+        return rows
+
+    async def close(self):
+        self.record()
+        await self.result_set.close()
+
+    def __getattr__(self, item):
+        return getattr(self.result_set, item)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        row = await self.fetch_row()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+        return False
+
+
+class InstrumentedInterface:
+    """A database interface whose sessions record their statements to :class:`Metrics`."""
+
+    def __init__(self, db: DatabaseInterface, metrics: Metrics):
+        self.interface = db
+        self.metrics = metrics
+
+    def get_session(self, **kwargs) -> Session:
+        session = self.interface.get_session(**kwargs)
+        metrics = self.metrics
+        # Statements whose rows were not all fetched are recorded when the session closes
+        open_results = []  # type: List[TimedResultSet]
+        start, close = session.start, session.close
+        execute, fetch, cursor = session.execute, session.fetch, session.cursor
+
+        async def timed_start():
+            began = time.perf_counter()
+            result = await start()
+            metrics.observe_connection_wait(time.perf_counter() - began)
+            return result
+
+        async def timed_close():
+            for i in open_results:
+                i.record()
+            open_results.clear()
+            return await close()
+
+        async def timed_execute(sql: str, params=None):
+            began = time.perf_counter()
+            try:
+                status = await execute(sql, params)
+            except BaseException:
+                metrics.observe_statement(sql, time.perf_counter() - began, None, error=True)
+                raise
+            rows = STATUS_ROWS.search(status) if isinstance(status, str) else None
+            metrics.observe_statement(sql, time.perf_counter() - began,
+                                      int(rows.group(1)) if rows else None)
+            return status
+
+        async def timed_fetch(sql: str, params=None):
+            began = time.perf_counter()
+            try:
+                row = await fetch(sql, params)
+            except BaseException:
+                metrics.observe_statement(sql, time.perf_counter() - began, None, error=True)
+                raise
+            metrics.observe_statement(sql, time.perf_counter() - began, int(row is not None))
+            return row
+
+        async def timed_cursor(sql: str, params=None):
+            began = time.perf_counter()
+            try:
+                result_set = await cursor(sql, params)
+            except BaseException:
+                metrics.observe_statement(sql, time.perf_counter() - began, None, error=True)
+                raise
+            timed = TimedResultSet(metrics, sql, result_set, time.perf_counter() - began)
+            open_results.append(timed)
+            return timed
+
+        session.start, session.close = timed_start, timed_close
+        session.execute, session.fetch, session.cursor = timed_execute, timed_fetch, timed_cursor
+        return session
+
+    def __getattr__(self, item):
+        return getattr(self.interface, item)
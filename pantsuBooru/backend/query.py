@@ -0,0 +1,314 @@
+import math
+import re
+from typing import Dict, Optional, Set, Tuple
+
+from .exceptions import BadQuery
+from .tag_index import Bitmap, TagIndex
+
+TOKEN = re.compile(r"\(|\)|[^\s()]+")
+
+#: Most tags a single query may contain.
+MAX_TAGS = 32
+
+
+class Term:
+    """A node of a parsed query, compared by kind and value."""
+
+    __slots__ = ()
+
+    def key(self) -> tuple:
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash((type(self), self.key()))
+
+    def __repr__(self):
+        return f"{type(self).__name__}{self.key()!r}"
+
+
+class TagTerm(Term):
+    __slots__ = ("tag",)
+
+    def __init__(self, tag: str):
+        self.tag = tag
+
+    def key(self):
+        return (self.tag,)
+
+
+class NotTerm(Term):
+    __slots__ = ("term",)
+
+    def __init__(self, term: Term):
+        self.term = term
+
+    def key(self):
+        return (self.term,)
+
+
+class GroupTerm(Term):
+    __slots__ = ("terms",)
+
+    def __init__(self, terms: Tuple[Term, ...]):
+        self.terms = terms
+
+    def key(self):
+        return self.terms
+
+
+class AndTerm(GroupTerm):
+    __slots__ = ()
+
+
+class OrTerm(GroupTerm):
+    __slots__ = ()
+
+
+#: Matches every image, an AND of nothing.
+ALL = AndTerm(())
+#: Matches no images, an OR of nothing.
+NOTHING = OrTerm(())
+
+
+class Parser:
+    """Parses queries such as ``cat dog -nsfw (blue_eyes OR green_eyes)``.
+
+    Tags next to each other are ANDed, OR (or ``|``) binds looser than AND,
+    and ``-`` or NOT negates the tag or group after it.
+    """
+
+    def __init__(self, query: str):
+        self.tokens = TOKEN.findall(query)
+        self.pos = 0
+        self.tags = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self) -> Optional[str]:
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self) -> Term:
+        if not self.tokens:
+            raise BadQuery("The query is empty")
+        term = self.parse_or()
+        if self.peek() is not None:
+            raise BadQuery(f"Unexpected {self.peek()!r}")
+        return term
+
+    def parse_or(self) -> Term:
+        terms = [self.parse_and()]
+        while self.peek() in ("OR", "|"):
+            self.next()
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else OrTerm(tuple(terms))
+
+    def parse_and(self) -> Term:
+        terms = [self.parse_unary()]
+        while self.peek() not in (None, ")", "OR", "|"):
+            if self.peek() in ("AND", "&"):
+                self.next()
+            terms.append(self.parse_unary())
+        return terms[0] if len(terms) == 1 else AndTerm(tuple(terms))
+
+    def parse_unary(self) -> Term:
+        token = self.next()
+        if token is None:
+            raise BadQuery("The query ended unexpectedly")
+        if token in ("-", "NOT"):
+            return NotTerm(self.parse_unary())
+        if token == "(":
+            term = self.parse_or()
+            if self.next() != ")":
+                raise BadQuery("Missing )")
+            return term
+        if token in (")", "OR", "|", "AND", "&"):
+            raise BadQuery(f"Unexpected {token!r}")
+        if token.startswith("-"):
+            return NotTerm(self.tag(token[1:]))
+        return self.tag(token)
+
+    def tag(self, tag: str) -> TagTerm:
+        self.tags += 1
+        if self.tags > MAX_TAGS:
+            raise BadQuery(f"Queries may have at most {MAX_TAGS} tags")
+        return TagTerm(tag.lower())
+
+
+def parse_query(query: str) -> Term:
+    """Parse a tag query.
+
+    :raises BadQuery: If the query is not valid.
+    """
+    return Parser(query).parse()
+
+
+def query_tags(term: Term) -> Set[str]:
+    """Get every tag in a query."""
+    if isinstance(term, TagTerm):
+        return {term.tag}
+    if isinstance(term, NotTerm):
+        return query_tags(term.term)
+    return set().union(*map(query_tags, term.terms))
+
+
+def estimate(term: Term, counts: Dict[str, int], total: float) -> float:
+    """Estimate how many images a planned query matches, assuming tags are independent."""
+    if isinstance(term, TagTerm):
+        return counts.get(term.tag, 0)
+    if isinstance(term, NotTerm):
+        return max(total - estimate(term.term, counts, total), 0)
+    if isinstance(term, OrTerm):
+        return min(sum(estimate(i, counts, total) for i in term.terms), total)
+    positive = [estimate(i, counts, total) for i in term.terms if not isinstance(i, NotTerm)]
+    return min(positive, default=total)
+
+
+def plan(term: Term, counts: Dict[str, int], total: float=math.inf) -> Term:
+    """Simplify a query and order it for evaluation.
+
+    Tags missing from ``counts`` match nothing, so they are folded away.
+    ANDs put their most selective positive terms first, then the exclusions
+    that remove the most. ORs put their most likely terms first.
+
+    :param term: The parsed query.
+    :param counts: Amount of images with each tag.
+    :param total: Amount of images in total.
+
+    :return: The planned query, :data:`ALL` or :data:`NOTHING` if it is constant.
+    """
+    if isinstance(term, TagTerm):
+        return term if counts.get(term.tag) else NOTHING
+
+    if isinstance(term, NotTerm):
+        inner = plan(term.term, counts, total)
+        if inner == ALL:
+            return NOTHING
+        if inner == NOTHING:
+            return ALL
+        if isinstance(inner, NotTerm):
+            return inner.term
+        return NotTerm(inner)
+
+    is_and = isinstance(term, AndTerm)
+    terms = []
+    for i in map(lambda i: plan(i, counts, total), term.terms):
+        if i == (NOTHING if is_and else ALL):
+            # Short circuits the whole group
+            return i
+        if i == (ALL if is_and else NOTHING):
+            continue
+        # Nested groups of the same kind are flattened
+        nested = i.terms if type(i) is type(term) else (i,)
+        terms.extend(j for j in nested if j not in terms)
+
+    if len(terms) == 1:
+        return terms[0]
+    if is_and:
+        positive = [i for i in terms if not isinstance(i, NotTerm)]
+        negative = [i for i in terms if isinstance(i, NotTerm)]
+        positive.sort(key=lambda i: estimate(i, counts, total))
+        negative.sort(key=lambda i: estimate(i.term, counts, total), reverse=True)
+        return AndTerm(tuple(positive + negative))
+    terms.sort(key=lambda i: estimate(i, counts, total), reverse=True)
+    return OrTerm(tuple(terms))
+
+
+def evaluate(term: Term, index: TagIndex) -> Bitmap:
+    """Find the images matching a planned query in a :class:`TagIndex`."""
+    if isinstance(term, TagTerm):
+        return index.bitmap(term.tag)
+    if isinstance(term, NotTerm):
+        return index.images - evaluate(term.term, index)
+    if isinstance(term, OrTerm):
+        result = Bitmap()
+        for i in term.terms:
+            result |= evaluate(i, index)
+        return result
+
+    result = None
+    for i in term.terms:
+        if result is not None and not result:
+            break
+        if isinstance(i, NotTerm):
+            if result is None:
+                result = index.images
+            result -= evaluate(i.term, index)
+        else:
+            matched = evaluate(i, index)
+            result = matched if result is None else result & matched
+    return index.images if result is None else result
+
+
+class CompiledQuery:
+    """Builds the SQL of a planned query, with tag IDs as parameters."""
+
+    def __init__(self, tag_ids: Dict[str, int]):
+        self.tag_ids = tag_ids
+        self.params = {}  # type: Dict[str, int]
+
+    def param(self, value) -> str:
+        name = f"${len(self.params) + 1}"
+        self.params[name] = value
+        return name
+
+    def source(self, term: Term) -> Optional[str]:
+        """SQL selecting a superset of the matching image IDs, None if every image is needed."""
+        if isinstance(term, TagTerm):
+            return ('SELECT "imagetag"."image_id" FROM "imagetag" '
+                    f'WHERE "imagetag"."tag_id" = {self.param(self.tag_ids[term.tag])}')
+        if isinstance(term, AndTerm) and term.terms:
+            # The most selective term drives the query
+            return self.source(term.terms[0])
+        if isinstance(term, OrTerm) and term.terms:
+            sources = [self.source(i) for i in term.terms]
+            if None not in sources:
+                return " UNION ".join(sources)
+        return None
+
+    def condition(self, term: Term) -> str:
+        """SQL condition on "image"."id" of the query."""
+        if isinstance(term, TagTerm):
+            return ('EXISTS (SELECT 1 FROM "imagetag" '
+                    'WHERE "imagetag"."image_id" = "image"."id" '
+                    f'AND "imagetag"."tag_id" = {self.param(self.tag_ids[term.tag])})')
+        if isinstance(term, NotTerm):
+            return f"NOT {self.condition(term.term)}"
+        if not term.terms:
+            return "TRUE" if isinstance(term, AndTerm) else "FALSE"
+        joiner = " AND " if isinstance(term, AndTerm) else " OR "
+        # Evaluated in order, so the planned order lets it stop early
+        return "(" + joiner.join(map(self.condition, term.terms)) + ")"
+
+    def where(self, term: Term) -> str:
+        """The WHERE clause of the query, on the "image" table."""
+        clauses = []
+        source = self.source(term)
+        if source is not None:
+            clauses.append(f'"image"."id" IN ({source})')
+            # Conditions the source already guarantees are not checked again
+            if isinstance(term, TagTerm) or (isinstance(term, OrTerm)
+                                             and all(isinstance(i, TagTerm) for i in term.terms)):
+                term = ALL
+            elif isinstance(term, AndTerm) and isinstance(term.terms[0], TagTerm):
+                term = AndTerm(term.terms[1:])
+        if term != ALL:
+            clauses.append(self.condition(term))
+        return " AND ".join(clauses) or "TRUE"
+
+
+def compile_query(term: Term, tag_ids: Dict[str, int]) -> Tuple[str, Dict[str, int]]:
+    """Compile a planned query to a WHERE clause on the "image" table.
+
+    :param term: The planned query.
+    :param tag_ids: IDs of the tags in the query.
+
+    :return: The clause and its parameters, numbered from $1.
+    """
+    compiled = CompiledQuery(tag_ids)
+    return compiled.where(term), compiled.params
@@ -0,0 +1,51 @@
+from datetime import datetime
+from typing import NamedTuple, Optional, Tuple
+
+
+class UserRecord(NamedTuple):
+    """Read only public fields of a user, for list endpoints."""
+
+    id: int
+    joined_at: Optional[datetime]
+    username: str
+
+    @classmethod
+    def from_record(cls, record: dict, prefix: str="") -> Optional['UserRecord']:
+        """Build from a raw query record, None if the user was not joined.
+
+        :param record: The record returned from a raw query.
+        :param prefix: Prefix the user columns were selected with.
+        """
+        if record[prefix + "id"] is None:
+            return None
+        return cls(record[prefix + "id"], record[prefix + "joined_at"],
+                   record[prefix + "username"])
+
+
+class ImageRecord(NamedTuple):
+    """Read only image with its tags and poster, for list endpoints.
+
+    These are plain tuples, far smaller and faster to build than
+    :class:`pantsuBooru.models.Image` rows. Fetch the row by ID to modify the image.
+    """
+
+    id: int
+    posted_at: Optional[datetime]
+    author: Optional[str]
+    source: Optional[str]
+    poster_id: Optional[int]
+    tags: Tuple[str, ...]
+    poster: Optional[UserRecord]
+    matches: int = 0
+
+    @property
+    def cursor(self) -> Tuple[int, int]:
+        """The keyset cursor to fetch the page after this result with."""
+        return (self.matches, self.id)
+
+    @classmethod
+    def from_record(cls, record: dict, matches: int=0) -> 'ImageRecord':
+        """Build from a record selected with :data:`.image_db.RESULT_COLUMNS`."""
+        return cls(record["id"], record["posted_at"], record["author"], record["source"],
+                   record["poster_id"], tuple(record["tags"]),
+                   UserRecord.from_record(record, "user_"), matches)
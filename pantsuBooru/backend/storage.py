@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterable, BinaryIO, Dict, Iterable, NamedTuple, Tuple, Union
+
+from PIL import Image as PILImage
+
+from .dedup import dhash
+
+log = logging.getLogger(__name__)
+
+Upload = Union[bytes, BinaryIO, AsyncIterable[bytes]]
+
+
+class Received(NamedTuple):
+    """An upload streamed to a temporary file."""
+
+    path: str
+    sha256: str
+    size: int
+
+
+def convert_image(upload: str, full: str, thumb: str,
+                  thumb_size: Tuple[int, int], quality: int) -> int:
+    """Convert an upload to the stored full PNG and JPEG thumbnail, then remove it.
+
+    Runs in a worker process.
+
+    :return: The perceptual hash of the image.
+    """
+    try:
+        with PILImage.open(upload) as im:
+            im.load()
+            has_alpha = im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info
+            full_im = im.convert("RGBA" if has_alpha else "RGB")
+
+        # Written under a temporary name so a half written file is never served
+        full_im.save(full + ".tmp", "PNG", optimize=True)
+        os.replace(full + ".tmp", full)
+
+        thumb_im = full_im.convert("RGB")
+        thumb_im.thumbnail(thumb_size)
+        thumb_im.save(thumb + ".tmp", "JPEG", quality=quality, optimize=True)
+        os.replace(thumb + ".tmp", thumb)
+
+        return dhash(thumb_im)
+    finally:
+        os.remove(upload)
+
+
+def remove_files(paths: Iterable[str]) -> int:
+    """Remove files, ignoring ones that don't exist.
+
+    :return: The amount of files removed.
+    """
+    removed = 0
+    for i in paths:
+        try:
+            os.remove(i)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+class ImageStorage:
+    """Stores uploaded images on disk as ``{id}_full.png`` and ``{id}_thumb.jpeg``.
+
+    Uploads are streamed to disk and converted in a process pool in the background.
+
+    :param root: Directory to store images in.
+    :param workers: Size of the conversion process pool.
+    :param thumb_size: Bounding box of the thumbnails.
+    :param quality: JPEG quality of the thumbnails.
+    :param chunk_size: Size of the chunks uploads are read in.
+    :param loop: The event loop to use.
+    """
+
+    def __init__(self, root: str, *,
+                 workers: int=2,
+                 thumb_size: Tuple[int, int]=(300, 300),
+                 quality: int=85,
+                 chunk_size: int=64 * 1024,
+                 loop: asyncio.AbstractEventLoop=None):
+        self.root = root
+        self.workers = workers
+        self.thumb_size = thumb_size
+        self.quality = quality
+        self.chunk_size = chunk_size
+        self.loop = loop or asyncio.get_event_loop()
+
+        os.makedirs(root, exist_ok=True)
+        self._executor = None  # type: ProcessPoolExecutor
+        #: Conversions that have not finished, by image ID.
+        self.pending = {}  # type: Dict[int, asyncio.Future]
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """The conversion pool, created on first use."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def full_path(self, image_id: int) -> str:
+        return os.path.join(self.root, f"{image_id}_full.png")
+
+    def thumb_path(self, image_id: int) -> str:
+        return os.path.join(self.root, f"{image_id}_thumb.jpeg")
+
+    def upload_path(self, image_id: int) -> str:
+        return os.path.join(self.root, f"{image_id}_upload")
+
+    async def _chunks(self, upload: Upload):
+        if isinstance(upload, bytes):
+            for i in range(0, len(upload), self.chunk_size):
+                yield upload[i:i + self.chunk_size]
+        elif hasattr(upload, "__aiter__"):
+            async for i in upload:
+                yield i
+        else:
+            while True:
+                chunk = upload.read(self.chunk_size)
+                if asyncio.iscoroutine(chunk):
+                    chunk = await chunk
+                if not chunk:
+                    break
+                yield chunk
+
+    async def receive(self, upload: Upload) -> Received:
+        """Stream an upload to a temporary file, hashing it on the way.
+
+        :param upload: Bytes, a file like object or an async iterable of bytes.
+
+        :return: The :class:`Received` file, to pass to :meth:`store`.
+        """
+        path = os.path.join(self.root, f"{uuid.uuid4().hex}.part")
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(path, "wb") as f:
+                async for i in self._chunks(upload):
+                    sha256.update(i)
+                    size += len(i)
+                    await self.loop.run_in_executor(None, f.write, i)
+        except BaseException:
+            remove_files([path])
+            raise
+        return Received(path, sha256.hexdigest(), size)
+
+    def store(self, image_id: int, received: Received) -> asyncio.Future:
+        """Start converting a received upload for an image in the background.
+
+        :param image_id: ID of the image the upload belongs to.
+        :param received: The :class:`Received` upload.
+
+        :return: Future of the conversion, resulting in the image's perceptual hash.
+        """
+        upload = self.upload_path(image_id)
+        os.replace(received.path, upload)
+
+        future = self.loop.run_in_executor(
+            self.executor, convert_image, upload, self.full_path(image_id),
+            self.thumb_path(image_id), self.thumb_size, self.quality)
+        self.pending[image_id] = future
+        future.add_done_callback(lambda f: self._converted(image_id, f))
+        return future
+
+    def _converted(self, image_id: int, future: asyncio.Future):
+        if self.pending.get(image_id) is future:
+            del self.pending[image_id]
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Converting image %d failed", image_id, exc_info=future.exception())
+
+    def discard(self, received: Received):
+        """Remove a received upload that won't be stored."""
+        remove_files([received.path])
+
+    async def delete(self, *image_ids: int) -> int:
+        """Delete the stored files of images.
+
+        Conversions still running for the images are waited for first.
+
+        :return: The amount of files removed.
+        """
+        running = [self.pending[i] for i in image_ids if i in self.pending]
+        if running:
+            await asyncio.wait(running)
+
+        paths = [p for i in image_ids
+                 for p in (self.full_path(i), self.thumb_path(i), self.upload_path(i))]
+        return await self.loop.run_in_executor(None, remove_files, paths)
+
+    def delete_later(self, *image_ids: int) -> asyncio.Future:
+        """Delete the stored files of images in the background."""
+        future = self.loop.create_task(self.delete(*image_ids))
+        future.add_done_callback(self._deleted)
+        return future
+
+    def _deleted(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Deleting image files failed", exc_info=future.exception())
+
+    async def close(self):
+        """Wait for running conversions and shut down the pool."""
+        if self.pending:
+            await asyncio.wait(list(self.pending.values()))
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,278 @@
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+# Bitmaps are split into chunks of 2 ** CHUNK_BITS bits, each stored as an int.
+# Chunks with no bits set are not stored, so rare tags stay small.
+CHUNK_BITS = 12
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+class Bitmap:
+    """A compressed bitmap of non-negative integers.
+
+    Only chunks that have a bit set are stored,
+    set operations work chunk by chunk on python ints.
+    """
+
+    __slots__ = ("chunks",)
+
+    def __init__(self, values: Iterable[int]=(), *, chunks: Dict[int, int]=None):
+        self.chunks = {} if chunks is None else chunks
+        for i in values:
+            self.add(i)
+
+    def add(self, value: int):
+        key = value >> CHUNK_BITS
+        self.chunks[key] = self.chunks.get(key, 0) | (1 << (value & CHUNK_MASK))
+
+    def discard(self, value: int):
+        key = value >> CHUNK_BITS
+        chunk = self.chunks.get(key, 0) & ~(1 << (value & CHUNK_MASK))
+        if chunk:
+            self.chunks[key] = chunk
+        else:
+            self.chunks.pop(key, None)
+
+    def copy(self) -> 'Bitmap':
+        return Bitmap(chunks=dict(self.chunks))
+
+    def __contains__(self, value: int) -> bool:
+        return bool(self.chunks.get(value >> CHUNK_BITS, 0) >> (value & CHUNK_MASK) & 1)
+
+    def __len__(self) -> int:
+        return sum(bin(i).count("1") for i in self.chunks.values())
+
+    def __bool__(self) -> bool:
+        return bool(self.chunks)
+
+    def __and__(self, other: 'Bitmap') -> 'Bitmap':
+        small, large = sorted((self.chunks, other.chunks), key=len)
+        chunks = {}
+        for k, v in small.items():
+            v &= large.get(k, 0)
+            if v:
+                chunks[k] = v
+        return Bitmap(chunks=chunks)
+
+    def __or__(self, other: 'Bitmap') -> 'Bitmap':
+        chunks = dict(self.chunks)
+        for k, v in other.chunks.items():
+            chunks[k] = chunks.get(k, 0) | v
+        return Bitmap(chunks=chunks)
+
+    def __xor__(self, other: 'Bitmap') -> 'Bitmap':
+        chunks = dict(self.chunks)
+        for k, v in other.chunks.items():
+            v ^= chunks.get(k, 0)
+            if v:
+                chunks[k] = v
+            else:
+                chunks.pop(k, None)
+        return Bitmap(chunks=chunks)
+
+    def __sub__(self, other: 'Bitmap') -> 'Bitmap':
+        chunks = {}
+        for k, v in self.chunks.items():
+            v &= ~other.chunks.get(k, 0)
+            if v:
+                chunks[k] = v
+        return Bitmap(chunks=chunks)
+
+    def __iter__(self) -> Iterator[int]:
+        for k in sorted(self.chunks):
+            chunk = self.chunks[k]
+            while chunk:
+                low = chunk & -chunk
+                yield (k << CHUNK_BITS) | (low.bit_length() - 1)
+                chunk ^= low
+
+    def __reversed__(self) -> Iterator[int]:
+        return self.descending()
+
+    def descending(self, before: int=None) -> Iterator[int]:
+        """Iterate values from highest to lowest.
+
+        :param before: Only yield values lower than this.
+        """
+        keys = sorted(self.chunks, reverse=True)
+        if before is not None:
+            keys = [k for k in keys if k <= before >> CHUNK_BITS]
+        for k in keys:
+            chunk = self.chunks[k]
+            if before is not None and k == before >> CHUNK_BITS:
+                chunk &= (1 << (before & CHUNK_MASK)) - 1
+            while chunk:
+                bit = chunk.bit_length() - 1
+                yield (k << CHUNK_BITS) | bit
+                chunk ^= 1 << bit
+
+    def __repr__(self):
+        return f"<Bitmap len={len(self)}>"
+
+
+def count_slices(bitmaps: Iterable[Bitmap]) -> List[Bitmap]:
+    """Count how many of the bitmaps each value is in.
+
+    The counts are returned bit-sliced, the nth bitmap holds the nth bit of each count.
+
+    :param bitmaps: The bitmaps to count.
+
+    :return: List of bitmaps, least significant bit first.
+    """
+    slices = []
+    for carry in bitmaps:
+        for n, s in enumerate(slices):
+            slices[n] = s ^ carry
+            carry = s & carry
+            if not carry:
+                break
+        else:
+            if carry:
+                slices.append(carry)
+    return slices
+
+
+class TagIndex:
+    """In memory inverted index of tags to the images that have them."""
+
+    def __init__(self):
+        #: Mapping of tag to :class:`Bitmap` of image IDs.
+        self.tags = {}  # type: Dict[str, Bitmap]
+        #: Mapping of image ID to its set of tags.
+        self.image_tags = {}  # type: Dict[int, Set[str]]
+        #: Every image known to the index, tagged or not.
+        self.images = Bitmap()
+
+    def bitmap(self, tag: str) -> Bitmap:
+        """Get the images that have a tag."""
+        return self.tags.get(tag.lower(), Bitmap())
+
+    def add(self, image_id: int, *tags: str):
+        """Add tags to an image.
+
+        :param image_id: ID of the image.
+        :param tags: Tags to add.
+        """
+        self.images.add(image_id)
+        image_tags = self.image_tags.setdefault(image_id, set())
+        for i in map(str.lower, tags):
+            self.tags.setdefault(i, Bitmap()).add(image_id)
+            image_tags.add(i)
+
+    def remove(self, image_id: int, *tags: str):
+        """Remove tags from an image.
+
+        :param image_id: ID of the image.
+        :param tags: Tags to remove.
+        """
+        image_tags = self.image_tags.get(image_id, set())
+        for i in map(str.lower, tags):
+            image_tags.discard(i)
+            bitmap = self.tags.get(i)
+            if bitmap is None:
+                continue
+            bitmap.discard(image_id)
+            if not bitmap:
+                del self.tags[i]
+
+    def clear_tags(self, *image_ids: int):
+        """Remove every tag from images, keeping the images indexed.
+
+        :param image_ids: IDs of the images.
+        """
+        for i in image_ids:
+            self.remove(i, *self.image_tags.pop(i, ()))
+
+    def discard_images(self, *image_ids: int):
+        """Remove images from the index entirely.
+
+        :param image_ids: IDs of the images.
+        """
+        self.clear_tags(*image_ids)
+        for i in image_ids:
+            self.images.discard(i)
+
+    def match(self,
+              all_of: Iterable[str]=(),
+              any_of: Iterable[str]=(),
+              none_of: Iterable[str]=()) -> Bitmap:
+        """Find images matching a boolean tag query.
+
+        :param all_of: Tags that must all be present.
+        :param any_of: Tags of which at least one must be present.
+        :param none_of: Tags that must not be present.
+
+        :return: :class:`Bitmap` of matching image IDs.
+        """
+        # Intersect the rarest bitmaps first so intermediates stay small
+        required = sorted(map(self.bitmap, all_of), key=len)
+        optional = [self.bitmap(i) for i in any_of]
+
+        if required:
+            result = required[0]
+            for i in required[1:]:
+                if not result:
+                    break
+                result &= i
+        else:
+            result = self.images
+
+        if optional:
+            union = Bitmap()
+            for i in optional:
+                union |= i
+            result &= union
+
+        for i in none_of:
+            if not result:
+                break
+            result -= self.bitmap(i)
+        return result
+
+    def rank(self, *tags: str, limit: int=100,
+             after: Tuple[int, int]=None) -> List[Tuple[int, int]]:
+        """Rank images by how many of the tags they have.
+
+        :param tags: Tags to rank by.
+        :param limit: Maximum number of results.
+        :param after: (matches, image_id) keyset cursor to start after.
+
+        :return: List of (image_id, matches), most matches then newest first.
+        """
+        bitmaps = [self.bitmap(i) for i in set(map(str.lower, tags))]
+        slices = count_slices(bitmaps)
+        union = Bitmap()
+        for i in bitmaps:
+            union |= i
+
+        top = (1 << len(slices)) - 1
+        if after is not None:
+            top = min(top, after[0])
+
+        results = []
+        for matches in range(top, 0, -1):
+            exact = union
+            for bit, s in enumerate(slices):
+                if matches >> bit & 1:
+                    exact &= s
+                else:
+                    exact -= s
+            before = after[1] if after is not None and matches == after[0] else None
+            for i in exact.descending(before):
+                results.append((i, matches))
+                if len(results) >= limit:
+                    return results
+        return results
+
+    def page(self, bitmap: Bitmap, limit: int=100, before: int=None) -> List[int]:
+        """Take a page of image IDs from a bitmap, newest first.
+
+        :param bitmap: The bitmap of image IDs.
+        :param limit: Maximum number of IDs.
+        :param before: Only return IDs lower than this.
+        """
+        results = []
+        for i in bitmap.descending(before):
+            results.append(i)
+            if len(results) >= limit:
+                break
+        return results
@@ -1,21 +1,43 @@
 from datetime import datetime
 from typing import Optional
 
-from passlib.hash import bcrypt
-
 from pantsuBooru.backend.exceptions import UserExists
 from pantsuBooru.models import User, Comment, Image
 
+from .hashing import PasswordHasher
+from .loader import BatchLoader
 from .utils import BaseDatabase, make_comp_search
 
 
 class UserDB(BaseDatabase):
+    def __init__(self, *args, hasher: PasswordHasher=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Kept off the default executor so signups can't starve other blocking calls
+        self.hasher = hasher or PasswordHasher(loop=self.loop)
+
+    def _make_loaders(self):
+        super()._make_loaders()
+        # Batches get_user(id=...) lookups made concurrently into one query
+        self.user_loader = BatchLoader(self.get_many_users, key=lambda u: u.id,
+                                       loop=self.loop)
+
     def hash_password(self, password: str):
         """Hash a password with bcrypt.
 
         This function returns a coroutine.
+
+        :raises HashQueueFull: If the hashing queue stays full.
+        """
+        return self.hasher.hash(password)
+
+    def verify_password(self, password: str, hash: str):
+        """Check a password against a bcrypt hash.
+
+        This function returns a coroutine.
+
+        :raises HashQueueFull: If the hashing queue stays full.
         """
-        return self.loop.run_in_executor(None, bcrypt.hash, password)
+        return self.hasher.verify(password, hash)
 
     async def create_user(self, username: str, email: str,
                           password: str) -> User:
@@ -64,10 +86,12 @@ class UserDB(BaseDatabase):
         hash = await self.hash_password(password)
 
         async with self.db.get_session() as s:
-            await s.merge(user)
+            await s.execute("""UPDATE "user" SET "password" = $1 WHERE "id" = $2""",
+                            {"$1": hash, "$2": user_id})
+
+        self.evict_users(user_id)
         return hash
 
-    # TODO: Create cache for this
     async def get_user(self,
                        *,
                        username: str=None,
@@ -83,18 +107,77 @@ class UserDB(BaseDatabase):
 
         :return: The :class:`pantsuBooru.models.User` object found.
         """
+        lookup = [(k, v) for k, v in (("id", id), ("username", username), ("email", email))
+                  if v is not None]
+        if len(lookup) == 1:
+            user = self.cached_user(*lookup[0])
+            if user is not None:
+                return user
+
         condition = make_comp_search(
             User, username=username, email=email, id=id)
 
+        # Not cached if it is changed while being fetched
+        token = self.user_cache.token()
         async with self.db.get_session() as s:
             q = s.select(User)
             q.add_condition(condition)
-            return await q.first()
+            user = await q.first()
+
+        self.cache_user(user, token)
+        return user
+
+    async def get_many_users(self, *user_ids: int) -> [User]:
+        """Retrieve users given a list of user IDs.
+        The order of users retrieved is preserved
+
+        :param user_ids: List of user IDs to fetch.
+
+        :return: A list of :class:`pantsuBooru.models.User`.
+        """
+        users = {}
+        for i in user_ids:
+            user = self.cached_user("id", i)
+            if user is not None:
+                users[i] = user
+
+        missing = [i for i in set(user_ids) if i not in users]
+        if missing:
+            token = self.user_cache.token()
+            async with self.db.get_session() as s:
+                fetched = await s.select(User).where(User.id.in_(*missing)).all()
+                fetched = await fetched.flatten()
+
+            for i in fetched:
+                self.cache_user(i, token)
+                users[i.id] = i
+
+        return [users[i] for i in user_ids if i in users]
+
+    def load_user(self, user_id: int):
+        """Get a user by id, batched with other loads made at the same time.
+
+        This function returns a future.
+        """
+        return self.user_loader.load(user_id)
 
     async def delete_user(self, user_id: int) -> User:
         """Delete a user and also delete their corresponding images and comments.
 
+        Everything is deleted in one transaction, see :meth:`DeletionDB.delete_users`
+        for users with many images.
+
         :param user_id: ID of the user object to delete.
         """
         async with self.db.get_session() as s:
-            return await s.remove(User(id=user_id))
+            q = await s.cursor("""SELECT "id" FROM "image" WHERE "poster" = $1""",
+                               {"$1": user_id})
+            async with q as c:
+                image_ids = [i["id"] async for i in c]
+            # Unlinked before the cascade, so orphaned tags are handled
+            unlinked = await self._unlink_tags(s, image_ids) if image_ids else []
+            user = await s.remove(User(id=user_id))
+
+        self.evict_users(user_id)
+        self._images_deleted(*image_ids, unlinked=unlinked)
+        return user
@@ -1,11 +1,25 @@
 import asyncio
-from typing import Union
+import copy
+import functools
+import inspect
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
+import asyncpg
 from asyncqlio.db import DatabaseInterface
+from asyncqlio.orm.session import Session
 from asyncqlio.orm.operators import And, ComparisonOp, Eq, Or
 from asyncqlio.orm.schema.table import Table as SchemaTable
 
-from pantsuBooru.models import Table
+from pantsuBooru.models import Table, User
+
+from . import migrations
+from .cache import LRUCache
+from .invalidation import Invalidator
+from .metrics import InstrumentedInterface, Metrics, timed_method
+from .storage import ImageStorage
+
+log = logging.getLogger(__name__)
 
 
 def make_comp_search(table: SchemaTable, comp_op: ComparisonOp=Eq, join_op: Union[Or, And]=Or, **matches) -> Union[Or, And]:
@@ -24,8 +38,401 @@ def make_comp_search(table: SchemaTable, comp_op: ComparisonOp=Eq, join_op: Unio
     return join_op(*searches)
 
 
+def row_from_record(table: SchemaTable, record: dict, prefix: str="") -> Table:
+    """Build a table row from a raw query record.
+
+    :param table: The table to build a row of.
+    :param record: The record returned from a raw query.
+    :param prefix: Prefix the columns of the table were selected with.
+
+    :return: The built row, marked as existing in the database.
+    """
+    values = {c.name: record[prefix + c.name]
+              for c in table.iter_columns() if prefix + c.name in record}
+    if all(i is None for i in values.values()):
+        # Left joined row that didn't exist
+        return None
+    return table._internal_from_row(values, existed=True)
+
+
+class SharedSession:
+    """Hands out an already started session without committing or closing it on exit."""
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    async def __aenter__(self) -> Session:
+        return self.session
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class BoundInterface:
+    """A database interface whose sessions are all one shared session."""
+
+    def __init__(self, db: DatabaseInterface, session: Session):
+        self.interface = db
+        self.session = session
+
+    def get_session(self, **kwargs) -> SharedSession:
+        return SharedSession(self.session)
+
+    def __getattr__(self, item):
+        return getattr(self.interface, item)
+
+
+class HeldUpdates:
+    """Stands in for an in memory index inside a transaction.
+
+    Reads go to the index, calls of its updating methods are held to be applied on commit.
+
+    :param index: The index stood in for.
+    :param updates: Names of the methods that update it.
+    :param held: List the held calls are appended to.
+    """
+
+    def __init__(self, index, updates: Iterable[str], held: List[Callable[[], None]]):
+        self._index = index
+        self._updates = frozenset(updates)
+        self._held = held
+
+    def __getattr__(self, name):
+        attr = getattr(self._index, name)
+        if name in self._updates:
+            return functools.partial(self._hold, attr)
+        return attr
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def _hold(self, method, *args, **kwargs):
+        self._held.append(functools.partial(method, *args, **kwargs))
+
+
+class Transaction:
+    """Runs a chain of backend calls in a single session.
+
+    Entering gives a copy of the database whose calls all use the same connection,
+    which is committed on exit, or rolled back if an exception was raised.
+
+    The copy has caches of its own, and its updates of in memory indexes, cache evictions
+    and invalidation events are held until commit, then applied to the original.
+    On rollback they are dropped.
+    """
+
+    def __init__(self, database: 'BaseDatabase'):
+        self.database = database
+        self.session = None
+        self.bound = None
+
+    async def __aenter__(self) -> 'BaseDatabase':
+        if isinstance(self.database.db, BoundInterface):
+            # Already inside a transaction, join it
+            return self.database
+
+        self.session = self.database.db.get_session()
+        await self.session.start()
+
+        bound = copy.copy(self.database)
+        bound.db = BoundInterface(self.database.db, self.session)
+        bound._held_events = []
+        bound._held_updates = []
+        # Rows read inside the transaction may never be committed
+        bound.user_cache = LRUCache(self.database.user_cache.maxsize,
+                                    self.database.user_cache.ttl)
+        bound.image_cache = LRUCache(self.database.image_cache.maxsize,
+                                     self.database.image_cache.ttl)
+        for name, updates in bound._held_indexes.items():
+            index = getattr(bound, name)
+            if index is not None:
+                setattr(bound, name, HeldUpdates(index, updates, bound._held_updates))
+        self.bound = bound
+        if bound.metrics is not None:
+            # The copied wrappers still call the methods of the original
+            bound._time_methods()
+        # The copied loaders would load through the original, outside the transaction
+        bound._make_loaders()
+        return bound
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.session is None:
+            return False
+
+        try:
+            if exc_type is None:
+                await self.session.commit()
+                for update in self.bound._held_updates:
+                    update()
+                for kind, ids in self.bound._held_events:
+                    # Rows read meanwhile may be cached from before the commit
+                    self.database._evict(kind, ids)
+                    self.database.publish(kind, *ids)
+            else:
+                await self.session.rollback()
+        finally:
+            await self.session.close()
+        return False
+
+
 class BaseDatabase:
-    def __init__(self, db: DatabaseInterface, loop=None):
+    #: Where image files are stored, if anywhere.
+    storage = None  # type: Optional[ImageStorage]
+
+    #: The :class:`Metrics` being recorded, if instrumentation is on.
+    metrics = None  # type: Optional[Metrics]
+
+    #: The :class:`Invalidator` keeping other processes' caches coherent, if running.
+    invalidator = None  # type: Optional[Invalidator]
+    # Events published inside a transaction, sent once it commits
+    _held_events = None  # type: Optional[List[Tuple[str, Tuple[int, ...]]]]
+    # Updates of in memory indexes made inside a transaction, applied once it commits
+    _held_updates = None  # type: Optional[List[Callable[[], None]]]
+    # In memory indexes held by transactions, by attribute, with the methods that update them
+    _held_indexes = {}  # type: Dict[str, Tuple[str, ...]]
+
+    def __init__(self, db: DatabaseInterface, loop=None, *,
+                 cache_size: int=1024, cache_ttl: Optional[float]=300):
         self.db = db
         self.db.bind_tables(Table)
         self.loop = asyncio.get_event_loop()
+
+        # Users are stored under ("id", id), with ("username", ...) and ("email", ...)
+        # keys pointing to the id so that evicting the id evicts every lookup.
+        self.user_cache = LRUCache(cache_size, cache_ttl)
+        self.image_cache = LRUCache(cache_size, cache_ttl)
+        self._make_loaders()
+
+    def _make_loaders(self):
+        """Create the batch loaders, which load through this object's interface."""
+
+    async def connect(self, dsn: str=None, *,
+                      min_size: int=10,
+                      max_size: int=10,
+                      statement_cache_size: int=100,
+                      command_timeout: Optional[float]=None,
+                      connect_timeout: float=60,
+                      max_inactive_connection_lifetime: float=300,
+                      **options):
+        """Connect the database interface with a configured connection pool.
+
+        :param dsn: The dsn to connect to, if not given to the interface already.
+        :param min_size: Connections the pool is started with.
+        :param max_size: Most connections the pool will open.
+        :param statement_cache_size: Prepared statements cached per connection.
+        :param command_timeout: Default timeout of a statement in seconds.
+        :param connect_timeout: Timeout of establishing a connection in seconds.
+        :param max_inactive_connection_lifetime: Seconds before idle connections are closed.
+        :param options: Any other options to create the asyncpg pool with.
+        """
+        connector = await self.db.connect(dsn)
+        if not hasattr(connector, "pool"):
+            # Not a pooled connector, nothing to configure
+            return
+
+        # asyncqlio only takes pool options from the dsn query string,
+        # so the pool it creates is swapped for a configured one.
+        default_pool = connector.pool
+        # Options given here take precedence over the same ones in the dsn
+        explicit = {"min_size", "max_size", "statement_cache_size", "command_timeout",
+                    "timeout", "max_inactive_connection_lifetime"}
+        options = dict({k: v for k, v in connector.params.items() if k not in explicit},
+                       **options)
+        connector.pool = await asyncpg.create_pool(
+            host=connector.host,
+            port=connector.port or 5432,
+            user=connector.username,
+            password=connector.password,
+            database=connector.db,
+            min_size=min_size,
+            max_size=max_size,
+            statement_cache_size=statement_cache_size,
+            command_timeout=command_timeout,
+            timeout=connect_timeout,
+            max_inactive_connection_lifetime=max_inactive_connection_lifetime,
+            **options)
+        await default_pool.close()
+        log.debug("Connected with a pool of %d-%d connections", min_size, max_size)
+
+    async def migrate(self, target: Optional[int]=None) -> List[int]:
+        """Apply the schema migrations the database is missing.
+
+        :param target: The version to migrate up to, the latest if not given.
+
+        :return: The versions applied.
+        """
+        return await migrations.migrate(self.db.connector.pool, target)
+
+    def pool_stats(self) -> dict:
+        """Get the size of the connection pool."""
+        pool = self.db.connector.pool
+        return {
+            "size": pool.get_size(),
+            "idle": pool.get_idle_size(),
+            "min_size": pool.get_min_size(),
+            "max_size": pool.get_max_size(),
+        }
+
+    def transaction(self) -> Transaction:
+        """Run a chain of calls on one connection, in one transaction.
+
+        .. code-block:: python3
+
+            async with db.transaction() as tx:
+                image = await tx.add_image(author, source, user_id, tags)
+                await tx.add_comment(image.id, user_id, "first")
+        """
+        return Transaction(self)
+
+    def clear_caches(self):
+        """Remove every entry from the row caches."""
+        self.user_cache.clear()
+        self.image_cache.clear()
+
+    def cache_stats(self) -> dict:
+        """Get the size and hit counters of the row caches."""
+        return {
+            "users": self.user_cache.stats(),
+            "images": self.image_cache.stats(),
+        }
+
+    def cache_user(self, user: User, token: int=None):
+        """Store a user row in the cache under its id, username and email.
+
+        :param user: The user row.
+        :param token: The :meth:`LRUCache.token` taken before it was fetched.
+        """
+        if user is None:
+            return
+        self.user_cache.set(("id", user.id), user, token)
+        self.user_cache.set(("username", user.username), user.id, token)
+        self.user_cache.set(("email", user.email), user.id, token)
+
+    def cached_user(self, kind: str, value) -> Optional[User]:
+        """Get a user from the cache.
+
+        :param kind: What to look up by, one of id, username or email.
+        :param value: The value to look up.
+        """
+        user_id = value if kind == "id" else self.user_cache.get((kind, value), count=False)
+        user = self.user_cache.get(("id", user_id))
+        if user is not None and getattr(user, kind) == value:
+            return user
+
+    def evict_users(self, *user_ids: int):
+        """Evict users from the cache, and from other processes' if invalidation is running."""
+        self.user_cache.evict(*(("id", i) for i in user_ids))
+        self.publish("user", *user_ids)
+
+    def evict_images(self, *image_ids: int):
+        """Evict images from the cache, and from other processes' if invalidation is running."""
+        self.image_cache.evict(*image_ids)
+        self.publish("image", *image_ids)
+
+    async def _unlink_tags(self, s, image_ids: Iterable[int]) -> List[Tuple[int, str]]:
+        """Delete every tag link of images inside a session, see :meth:`ImageDB._unlink_tags`."""
+        return []
+
+    def _images_deleted(self, *image_ids: int, unlinked: Iterable[Tuple[int, str]]=()):
+        """Clean up after this process deleted images, other processes are told to as well.
+
+        :param image_ids: IDs of the deleted images.
+        :param unlinked: The (id, tag) of every tag link removed with them.
+        """
+        self.evict_images(*image_ids)
+        self.publish("image_deleted", *image_ids)
+        self.publish("tag", *{i for i, _ in unlinked})
+        if self.storage is not None:
+            # Files of a delete that is rolled back are kept
+            self._after_commit(functools.partial(self.storage.delete_later, *image_ids))
+
+    def publish(self, kind: str, *ids: int):
+        """Tell other processes something changed, if invalidation is running.
+
+        Inside a transaction, events are held until it commits.
+
+        :param kind: What changed, handled by :meth:`_invalidate`.
+        :param ids: IDs of what changed.
+        """
+        if self._held_events is not None:
+            self._held_events.append((kind, ids))
+        elif self.invalidator is not None and ids:
+            self.invalidator.publish(kind, ids)
+
+    async def start_invalidation(self, check_interval: float=5):
+        """Keep the caches of every process using the database coherent.
+
+        Changes made through this object are published over postgres LISTEN/NOTIFY,
+        and changes published by other processes are evicted from the caches here.
+        This holds one connection of the pool.
+
+        :param check_interval: Seconds between checks of the listening connection.
+        """
+        if self.invalidator is None:
+            invalidator = Invalidator(self.db.connector.pool, self._invalidate, self._resync,
+                                      check_interval=check_interval, loop=self.loop)
+            await invalidator.start()
+            self.invalidator = invalidator
+
+    async def stop_invalidation(self):
+        """Stop publishing and receiving invalidations, sending the ones pending."""
+        invalidator, self.invalidator = self.invalidator, None
+        if invalidator is not None:
+            await invalidator.stop()
+
+    def _after_commit(self, update: Callable[[], None]):
+        """Run an update of in memory state now, or once the transaction commits inside one."""
+        if self._held_updates is not None:
+            self._held_updates.append(update)
+        else:
+            update()
+
+    async def _invalidate(self, kind: str, ids: List[int]):
+        """Apply a change published by another process."""
+        self._evict(kind, ids)
+
+    def _evict(self, kind: str, ids: List[int]):
+        """Evict what an event is about from the caches."""
+        if kind == "user":
+            self.user_cache.evict(*(("id", i) for i in ids))
+        elif kind == "image":
+            self.image_cache.evict(*ids)
+
+    def _resync(self):
+        """Called when invalidations may have been missed."""
+        self.clear_caches()
+
+    def instrument(self, metrics: Metrics=None, **options) -> Metrics:
+        """Start recording the latency of every backend method and SQL statement.
+
+        Nothing is wrapped until this is called, so there is no cost while it is off.
+
+        :param metrics: The :class:`Metrics` to record to, a new one is made if not given.
+        :param options: Passed to :class:`Metrics` when making one.
+
+        :return: The :class:`Metrics` being recorded to.
+        """
+        if self.metrics is not None:
+            self.uninstrument()
+        self.metrics = metrics or Metrics(**options)
+        self.db = InstrumentedInterface(self.db, self.metrics)
+        self._time_methods()
+        return self.metrics
+
+    def uninstrument(self):
+        """Stop recording metrics."""
+        if self.metrics is None:
+            return
+        for name, _ in inspect.getmembers(type(self), inspect.iscoroutinefunction):
+            self.__dict__.pop(name, None)
+        if isinstance(self.db, InstrumentedInterface):
+            self.db = self.db.interface
+        self.metrics = None
+
+    def _time_methods(self):
+        for name, fn in inspect.getmembers(type(self), inspect.iscoroutinefunction):
+            if not name.startswith("_"):
+                setattr(self, name, timed_method(fn.__get__(self), self.metrics, name))
@@ -0,0 +1,130 @@
+import asyncio
+import collections
+import logging
+from typing import Any, Awaitable, Callable, List, Optional
+
+log = logging.getLogger(__name__)
+
+
+class WriteQueue:
+    """Queues writes and runs them in batches, once ``max_batch`` are queued or after ``max_delay``.
+
+    Batches are written one at a time, in the order they were queued.
+    If a batch fails, its writes are retried one at a time, so a single bad write
+    only fails itself.
+
+    :param write_fn: Coroutine function taking a list of writes, returning a result for each
+        in the same order. A result may be an exception, raised to that write's caller.
+    :param max_batch: The most writes passed to ``write_fn`` at once.
+    :param max_delay: Seconds a write waits for others to join its batch.
+    :param max_pending: The most writes queued, :meth:`put` waits for room past it.
+    :param durable: If True, :meth:`put` returns a future of the write's result.
+        If False, nothing is returned and failures are only logged.
+    :param loop: The event loop to run the writer on.
+    """
+
+    def __init__(self,
+                 write_fn: Callable[[List[Any]], Awaitable[List[Any]]],
+                 *,
+                 max_batch: int=500,
+                 max_delay: float=0.01,
+                 max_pending: int=10000,
+                 durable: bool=True,
+                 loop: asyncio.AbstractEventLoop=None):
+        self.write_fn = write_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.durable = durable
+        self.loop = loop or asyncio.get_event_loop()
+
+        self._pending = collections.deque()
+        self._writing = []  # type: List[asyncio.Future]
+        self._ready = asyncio.Event()  # Something is queued
+        self._full = asyncio.Event()  # A batch is full or being flushed
+        self._room = asyncio.Event()  # There is room to queue more
+        self._room.set()
+        self._closed = False
+        self._task = self.loop.create_task(self._run())
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def put(self, item) -> Optional['asyncio.Future']:
+        """Queue a write, waiting for room if too many are queued.
+
+        :return: A future of the write's result if durable, else None.
+        """
+        while len(self._pending) >= self.max_pending:
+            self._room.clear()
+            await self._room.wait()
+        if self._closed:
+            raise RuntimeError("The write queue is closed")
+
+        future = self.loop.create_future()
+        self._pending.append((item, future))
+        self._ready.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return future if self.durable else None
+
+    async def flush(self):
+        """Wait until every write queued so far has been written."""
+        waiting = [f for _, f in self._pending] + self._writing
+        self._full.set()
+        await asyncio.gather(*waiting, return_exceptions=True)
+
+    async def close(self):
+        """Write everything queued and stop the writer."""
+        self._closed = True
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            if len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+
+            batch = [self._pending.popleft()
+                     for _ in range(min(self.max_batch, len(self._pending)))]
+            if not self._pending:
+                self._ready.clear()
+            self._room.set()
+
+            self._writing = [f for _, f in batch]
+            try:
+                await self._write(batch)
+            finally:
+                self._writing = []
+
+    async def _write(self, batch: list):
+        try:
+            results = await self.write_fn([i for i, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                log.warning("Writing a batch of %d failed, retrying them one by one", len(batch))
+                for i in batch:
+                    await self._write([i])
+                return
+            results = [e]
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if not isinstance(result, BaseException):
+                future.set_result(result)
+            elif self.durable:
+                future.set_exception(result)
+            else:
+                # Nobody is waiting on the future to see it
+                log.error("Queued write failed", exc_info=result)
+                future.set_result(None)
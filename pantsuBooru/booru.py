@@ -27,8 +27,8 @@ async def main():
         wew = await images.search_tags("wew")
         print(wew)
         image_get = await images.get_image(image.id)
-        print([i.tag for i in image_get.tags])
-        print(image_get.comments)
+        print(await images.get_image_tags(image_get.id))
+        print(await images.get_image_comments(image_get.id))
     except Exception as e:
         raise e
     finally:
@@ -1 +1 @@
-from .db_models import Image, Tag, Comment, User, Table, ImageTag
+from .db_models import Image, Tag, Comment, User, Table, ImageTag, TagRelation
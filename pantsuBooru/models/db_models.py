@@ -1,7 +1,7 @@
 from asyncqlio.orm.schema.column import Column
 from asyncqlio.orm.schema.relationship import ForeignKey, Relationship
 from asyncqlio.orm.schema.table import table_base
-from asyncqlio.orm.schema.types import Integer, Text, Timestamp
+from asyncqlio.orm.schema.types import BigInt, Boolean, Integer, Text, Timestamp
 
 Table = table_base("pantsu_booru")
 
@@ -13,8 +13,10 @@ class User(Table):
     email = Column(Text, nullable=False, unique=True)
     password = Column(Text, nullable=False)
 
-    posted_images = Relationship(id, "image.poster", load="joined")
-    posted_comments = Relationship(id, "comment.poster", load="joined")
+    # Select loaded, so fetching a user does not pull everything they have posted.
+    # Use ImageDB.get_user_images and get_user_comments to page through them.
+    posted_images = Relationship(id, "image.poster", load="select")
+    posted_comments = Relationship(id, "comment.poster", load="select")
 
 
 class Image(Table):
@@ -23,11 +25,16 @@ class Image(Table):
     author = Column(Text)
     source = Column(Text)
 
+    # SHA-256 of the uploaded file and perceptual hash of the image, for deduplication
+    sha256 = Column(Text)
+    dhash = Column(BigInt)
+
     poster_id = Column(Integer, foreign_key=ForeignKey(User.id))
 
     poster = Relationship(poster_id, User.id, load="joined", use_iter=False)
-    tags = Relationship(id, "imagetag.image_id", load="joined")
-    comments = Relationship(id, "comment.image_id", load="joined")
+    # Fetched on request with ImageDB.get_image_tags and get_comments
+    tags = Relationship(id, "imagetag.image_id", load="select")
+    comments = Relationship(id, "comment.image_id", load="select")
 
     # All images will be stored on disk in the format {database-id}_(full|thumb).(png|jpeg)
     # full images are stored in PNG format and are converted on upload
@@ -39,6 +46,12 @@ class Tag(Table):
     id = Column(Integer, primary_key=True, autoincrement=True)
     tag = Column(Text, unique=True)
 
+    # Amount of images with the tag, changes recorded by triggers on imagetag
+    # are added by ImageDB.fold_tag_counts
+    count = Column(Integer)
+    # Set by the same fold when the tag's related tags need recomputing
+    related_stale = Column(Boolean)
+
     images = Relationship(id, "imagetag.tag_id")
 
 
@@ -51,6 +64,13 @@ class ImageTag(Table):
     tag = Relationship(tag_id, Tag.id, load="joined", use_iter=False)
 
 
+class TagRelation(Table):
+    # Summary of how often two tags are on the same image, refreshed by ImageDB.refresh_related_tags
+    tag_id = Column(Integer, primary_key=True, foreign_key=ForeignKey(Tag.id))
+    related_id = Column(Integer, primary_key=True, foreign_key=ForeignKey(Tag.id))
+    count = Column(Integer)
+
+
 class Comment(Table):
     id = Column(Integer, primary_key=True, autoincrement=True)
     text = Column(Text)
@@ -59,38 +79,4 @@ class Comment(Table):
     poster = Column(Integer, foreign_key=ForeignKey(User.id))
 
 
-"""
-CREATE TABLE "user" (
-    id SERIAL PRIMARY KEY,
-    joined_at TIMESTAMP,
-    username TEXT NOT NULL UNIQUE,
-    email TEXT NOT NULL UNIQUE,
-    password TEXT NOT NULL
-);
-
-CREATE TABLE "image" (
-    id SERIAL PRIMARY KEY,
-    posted_at TIMESTAMP,
-    author TEXT,
-    source TEXT,
-    poster INTEGER REFERENCES "user" (id) ON DELETE CASCADE
-);
-
-CREATE TABLE "tag" (
-    id SERIAL PRIMARY KEY,
-    tag TEXT NOT NULL UNIQUE
-);
-
-CREATE TABLE "imagetag" (
-    id SERIAL PRIMARY KEY,
-    tag_id INTEGER REFERENCES "tag" (id) ON DELETE CASCADE,
-    image_id INTEGER REFERENCES "image" (id) ON DELETE CASCADE
-);
-
-CREATE TABLE "comment" (
-    id SERIAL PRIMARY KEY,
-    image_id INTEGER REFERENCES "image" (id) ON DELETE CASCADE,
-    poster INTEGER REFERENCES "user" (id) ON DELETE CASCADE,
-    text TEXT
-);
-"""
+# The tables are created and evolved by pantsuBooru.backend.migrations
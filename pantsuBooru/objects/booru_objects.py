@@ -1,9 +1,13 @@
+import asyncio
 import inspect
-from typing import Iterable
+from typing import AsyncIterator, Iterable, List, Optional, Union
 
-from pantsuBooru.backend import BooruDatabase
+from pantsuBooru.backend import BooruDatabase, ImageRecord, SearchResult, UserRecord
+from pantsuBooru.backend.image_db import unique_tags
 from pantsuBooru.models import Comment, Image, ImageTag, Tag, User
 
+from .serialization import image_json, stream_comments, stream_images, user_json
+
 
 class AsyncMeta(type):
     async def __call__(self, *args, **kwargs):
@@ -20,11 +24,9 @@ class BooruBase(metaclass=AsyncMeta):
         self.row = row
 
     def __getattr__(self, attr):
-        try:
-            return super().__getattr__(attr)
-        except AttributeError as e:
-            pass
-
+        # Only called for attributes not set on the object itself
+        if attr == "row":
+            raise AttributeError(attr)
         return getattr(self.row, attr)
 
     def to_json():
@@ -32,54 +34,199 @@ class BooruBase(metaclass=AsyncMeta):
 
 
 class BooruImage(BooruBase):
-    async def __init__(self, db: BooruDatabase, row: Image):
+    async def __init__(self, db: BooruDatabase, row: Image, *,
+                       poster: Union[User, UserRecord]=None, tags: List[str]=None,
+                       comments: List[Comment]=None, eager: bool=False):
         await super().__init__(db, row)
-        self.poster = await self.db.get_user(id=self.row.poster)
-        self.tags = [i.tag.tag
-                     for i in row.tags]  # row.tags is list of ImageTag
-        self.comments = list(row.comments)
+        if poster is None:
+            # Batched with the other images being built at the same time
+            poster = await self.db.load_user(self.row.poster_id)
+        self.poster = poster
+        if tags is None:
+            tags = await self.db.tag_loader.load(self.row.id)
+        self.tags = tags
+        #: The comments on the image, None until they are loaded.
+        self.comments = comments
+        if eager and comments is None:
+            await self.load_comments()
+
+    @classmethod
+    async def from_rows(cls, db: BooruDatabase, rows: Iterable[Image], *,
+                        eager: bool=False) -> ['BooruImage']:
+        """Build many images, fetching all of their posters and tags in one query each.
+
+        :param db: The database to use.
+        :param rows: The :class:`pantsuBooru.models.Image` rows to build from.
+        :param eager: If True, also fetch all of their comments.
+        """
+        rows = list(rows)
+        ids = [i.id for i in rows]
+        posters = await db.get_many_users(*{i.poster_id for i in rows})
+        posters = {i.id: i for i in posters}
+        tags = await db.get_image_tags(*ids)
+        comments = await db.get_comments(*ids) if eager else {}
+        return await asyncio.gather(*(cls(db, i, poster=posters.get(i.poster_id),
+                                          tags=tags[i.id], comments=comments.get(i.id))
+                                      for i in rows))
+
+    @classmethod
+    async def from_search_results(cls, db: BooruDatabase,
+                                  results: Iterable[SearchResult]) -> ['BooruImage']:
+        """Build images from search results, which already hold their posters and tags.
+
+        :param db: The database to use.
+        :param results: The :class:`pantsuBooru.backend.SearchResult` to build from.
+        """
+        return await asyncio.gather(*(cls(db, i.image, poster=i.poster, tags=i.tags)
+                                      for i in results))
+
+    async def load_comments(self) -> List[Comment]:
+        """Fetch all the comments on the image."""
+        self.comments = (await self.db.get_comments(self.id))[self.id]
+        return self.comments
+
+    async def iter_comments(self, page_size: int=100) -> AsyncIterator[Comment]:
+        """Iterate over the comments on the image, fetching them a page at a time.
+
+        :param page_size: Amount of comments to fetch per query.
+        """
+        after = None
+        while True:
+            page = await self.db.get_image_comments(self.id, limit=page_size, after=after)
+            for i in page:
+                yield i
+            if len(page) < page_size:
+                return
+            after = page[-1].id
 
     async def replace_tags(self, *tags: str):
         """Replace tags on the image.
 
         :param tags: The tags to replace on the image.
         """
-        self.tags.clear()
-        self.tags.extend(await self.db.replace_tags(self.id, *tags))
+        new_tags = await self.db.replace_tags(self.id, *tags)
+        self._set_tags(new_tags, lambda current: unique_tags(tags))
+
+    async def add_tags(self, *tags: str):
+        """Add tags to the image.
+
+        :param tags: The tags to add to the image.
+        """
+        new_tags = await self.db.add_tags(self.id, *tags)
+        self._set_tags(new_tags, lambda current: unique_tags(current + list(tags)))
+
+    async def remove_tags(self, *tags: str):
+        """Remove tags from the image.
+
+        :param tags: The tags to remove from the image.
+        """
+        new_tags = await self.db.remove_tags(self.id, *tags)
+        removed = set(map(str.lower, tags))
+        self._set_tags(new_tags, lambda current: [i for i in current if i not in removed])
+
+    def _set_tags(self, new_tags: Optional[List[str]], edit):
+        """Store the tags an edit left, applying it locally if it was queued without a result."""
+        if new_tags is None:
+            new_tags = edit(list(self.tags))
+        self.tags[:] = new_tags
 
     async def add_comment(self, text: str, poster: 'BooruUser'):
-        self.comments.append(
-            await self.db.add_comment(self.id, poster.id, text))
+        comment = await self.db.add_comment(self.id, poster.id, text)
+        if self.comments is not None:
+            self.comments.append(comment)
+        return comment
 
     async def delete(self):
         await self.db.delete_all_tags(self.id)
         await self.db.delete_image(self.id)
-        # TODO: Evict ourself from cache here
 
     def to_json(self, meta_only=True):
         """convert to json.
 
         :param meta_only: If True, dont include comments.
+            Otherwise the comments must have been loaded.
         """
-        d = {
-            "id": self.id,
-            "posted_at": self.posted_at.timestamp(),
-            "author": self.author,
-            "source": self.source,
-            "poster": self.poster.to_json(),
-            "tags": self.tags,
-        }
-
-        if not meta_only:
-            d["comments"] = [i.to_json() for i in self.comments]
+        if not meta_only and self.comments is None:
+            raise ValueError("The comments of the image have not been loaded")
+        d = image_json(self, meta_only)
+        d["poster"] = user_json(self.poster)
         return d
 
+    def stream_comments(self, **kwargs):
+        """Stream the comments as JSON bytes, see :func:`stream_comments`.
+
+        If the comments have not been loaded they are fetched a page at a time.
+        """
+        comments = self.iter_comments() if self.comments is None else self.comments
+        return stream_comments(comments, db=self.db, **kwargs)
+
 
 class BooruUser(BooruBase):
-    async def __init__(self, db: BooruDatabase, row: User):
+    async def __init__(self, db: BooruDatabase, row: User, *, eager: bool=False):
         await super().__init__(db, row)
-        self.posted_images = list(row.posted_images)
-        self.posted_comments = list(row.posted_comments)
+        #: The images and comments posted by the user, None until they are loaded.
+        self.posted_images = None  # type: Optional[List[BooruImage]]
+        self.posted_comments = None  # type: Optional[List[Comment]]
+        if eager:
+            await self.load_posted()
+
+    async def load_posted(self):
+        """Fetch everything posted by the user.
+
+        For users with a lot of posts use :meth:`iter_posted_images` instead.
+        """
+        rows = await self.db.get_user_images(self.id, limit=None)
+        self.posted_images = await BooruImage.from_rows(self.db, rows)
+        self.posted_comments = await self.db.get_user_comments(self.id, limit=None)
+
+    async def iter_posted_images(self, page_size: int=100, *,
+                                 eager: bool=False) -> AsyncIterator[BooruImage]:
+        """Iterate over the images posted by the user, newest first.
+
+        Images are fetched a page at a time, so only one page is held in memory.
+
+        :param page_size: Amount of images to fetch per query.
+        :param eager: If True, also fetch the comments of the images.
+        """
+        before = None
+        while True:
+            rows = await self.db.get_user_images(self.id, limit=page_size, before=before)
+            for i in await BooruImage.from_rows(self.db, rows, eager=eager):
+                yield i
+            if len(rows) < page_size:
+                return
+            before = rows[-1].id
+
+    async def iter_gallery(self, page_size: int=100) -> AsyncIterator[ImageRecord]:
+        """Iterate over the images posted by the user as read only records, newest first.
+
+        Cheaper than :meth:`iter_posted_images` for pages that only list images.
+
+        :param page_size: Amount of images to fetch per query.
+        """
+        before = None
+        while True:
+            page = await self.db.get_user_image_records(self.id, limit=page_size,
+                                                        before=before)
+            for i in page:
+                yield i
+            if len(page) < page_size:
+                return
+            before = page[-1].id
+
+    async def iter_posted_comments(self, page_size: int=100) -> AsyncIterator[Comment]:
+        """Iterate over the comments posted by the user, newest first.
+
+        :param page_size: Amount of comments to fetch per query.
+        """
+        before = None
+        while True:
+            page = await self.db.get_user_comments(self.id, limit=page_size, before=before)
+            for i in page:
+                yield i
+            if len(page) < page_size:
+                return
+            before = page[-1].id
 
     async def add_image(self, author: str, source: str, tags: Iterable[str]):
         """Add an image posted by this user.
@@ -88,9 +235,11 @@ class BooruUser(BooruBase):
         :param source: The source of the image.
         :param tags: Iterable of tags to add to the image.
         """
-        self.posted_images.append(
-            await self.db.add_image(author, source, self.id, tags))
-        self.add_image()
+        image = await self.db.add_image(author, source, self.id, tags)
+        image = await BooruImage(self.db, image, poster=self.row)
+        if self.posted_images is not None:
+            self.posted_images.insert(0, image)
+        return image
 
     async def add_comment(self, image: BooruImage, comment: str):
         """Add a comment to an image.
@@ -98,24 +247,37 @@ class BooruUser(BooruBase):
         :param image: The :class:`pantsuBooru.objects.BooruImage` to add the comment to.
         :param comment: The comment to add.
         """
-        self.posted_comments.append(
-            await self.db.add_comment(image.id, self.id, comment))
+        comment = await self.db.add_comment(image.id, self.id, comment)
+        if self.posted_comments is not None:
+            self.posted_comments.insert(0, comment)
+        return comment
 
     async def delete(self):
-        await self.db.delete_all_tags(*(i.id for i in self.posted_images))
-        await self.db.delete_user(self.id)
-        # TODO: Evict ourself from cache here
+        await self.db.delete_users(self.id)
 
     async def reset_password(self, password: str):
-        self.password = self.db.reset_password(self.id, password)
+        self.password = await self.db.reset_password(user_id=self.id, password=password)
 
     def to_json(self):
-        return {
-            "id": self.id,
-            "joined_at": self.joined_at,
-            "username": self.username,
-            "posted_images": [i.to_json() for i in self.posted_images]
-        }
+        d = user_json(self)
+        if self.posted_images is not None:
+            # The images' poster is this user, so it is not embedded again
+            d["posted_images"] = [image_json(i) for i in self.posted_images]
+        return d
+
+    def stream_gallery(self, meta_only=True, page_size: int=100, **kwargs):
+        """Stream the posted images as JSON bytes, see :func:`stream_images`.
+
+        Unless they have been loaded, images are fetched ``page_size`` at a time.
+        """
+        if not meta_only:
+            images = self.iter_posted_images(page_size, eager=True)
+        elif self.posted_images is None:
+            images = self.iter_gallery(page_size)
+        else:
+            images = self.posted_images
+        return stream_images(images, meta_only=meta_only,
+                             users={self.id: self.row}, **kwargs)
 
 
 class BooruComment(BooruBase):
@@ -0,0 +1,166 @@
+import json
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional, Union
+
+from pantsuBooru.models import Comment, User
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bytes collected before a chunk is yielded
+CHUNK_SIZE = 64 * 1024
+
+Items = Union[Iterable, AsyncIterable]
+
+
+def dumps(obj) -> bytes:
+    """Encode an object to JSON bytes, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def user_json(user: Union[User, 'UserRecord']) -> dict:
+    """The public fields of a user."""
+    return {
+        "id": user.id,
+        "joined_at": user.joined_at.timestamp() if user.joined_at else None,
+        "username": user.username,
+    }
+
+
+def image_json(image: Union['BooruImage', 'ImageRecord'], meta_only: bool=True) -> dict:
+    """The fields of an image, with its poster referenced by id.
+
+    :param image: A :class:`BooruImage`, with its comments loaded unless ``meta_only``,
+        or an :class:`ImageRecord` when ``meta_only``.
+    :param meta_only: If True, dont include comments.
+    """
+    d = {
+        "id": image.id,
+        "posted_at": image.posted_at.timestamp() if image.posted_at else None,
+        "author": image.author,
+        "source": image.source,
+        "poster": image.poster_id,
+        "tags": list(image.tags),
+    }
+
+    if not meta_only:
+        d["comments"] = [comment_json(i) for i in image.comments]
+    return d
+
+
+def comment_json(comment: Comment) -> dict:
+    return {
+        "id": comment.id,
+        "image_id": comment.image_id,
+        "poster": comment.poster,
+        "text": comment.text,
+    }
+
+
+class Chunker:
+    """Joins encoded parts into chunks of about ``size`` bytes."""
+
+    def __init__(self, size: int=CHUNK_SIZE):
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def add(self, part: bytes) -> Optional[bytes]:
+        """Add a part, returning a chunk if enough has been collected."""
+        self.parts.append(part)
+        self.length += len(part)
+        if self.length >= self.size:
+            return self.flush()
+
+    def flush(self) -> bytes:
+        chunk = b"".join(self.parts)
+        self.parts.clear()
+        self.length = 0
+        return chunk
+
+
+async def iterate(items: Items):
+    if hasattr(items, "__aiter__"):
+        async for i in items:
+            yield i
+    else:
+        for i in items:
+            yield i
+
+
+async def stream_list(key: str, items: Items, encode, *,
+                      users: dict=None,
+                      db: 'BooruDatabase'=None,
+                      chunk_size: int=CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Stream ``{key: [...], "users": {...}}`` as JSON bytes.
+
+    Items are encoded one at a time, so the whole list is never held in memory.
+
+    :param key: Key of the list in the response.
+    :param items: Iterable or async iterable of items.
+    :param encode: Function encoding an item to a dict, given the item, the users dict
+        and the set of referenced user ids.
+        It should add the ids of users it references to the set rather than embedding them.
+    :param users: Dict of user id to user already known.
+    :param db: Database to fetch referenced users from that were not given.
+    :param chunk_size: Approximate size of the chunks yielded.
+    """
+    users = {} if users is None else users
+    referenced = set()
+    chunker = Chunker(chunk_size)
+
+    chunker.add(b'{"' + key.encode() + b'":[')
+    first = True
+    async for i in iterate(items):
+        part = dumps(encode(i, users, referenced))
+        chunk = chunker.add(part if first else b"," + part)
+        first = False
+        if chunk:
+            yield chunk
+
+    missing = referenced - users.keys()
+    if missing and db is not None:
+        for i in await db.get_many_users(*missing):
+            users[i.id] = i
+
+    # Each user is written once, however many items reference them
+    chunker.add(b'],"users":')
+    chunker.add(dumps({str(k): user_json(v) for k, v in users.items()
+                       if k in referenced}))
+    chunker.add(b"}")
+    yield chunker.flush()
+
+
+def stream_images(images: Items, *, meta_only: bool=True, **kwargs) -> AsyncIterator[bytes]:
+    """Stream images as JSON bytes, with their posters written once each.
+
+    :param images: :class:`BooruImage` or :class:`ImageRecord`, such as search results
+        or a gallery.
+    :param meta_only: If True, dont include comments.
+    :param kwargs: Passed to :func:`stream_list`.
+    """
+    def encode(image, users, referenced):
+        if image.poster is not None:
+            users.setdefault(image.poster.id, image.poster)
+        referenced.add(image.poster_id)
+        if not meta_only:
+            referenced.update(i.poster for i in image.comments)
+        return image_json(image, meta_only)
+
+    return stream_list("images", images, encode, **kwargs)
+
+
+def stream_comments(comments: Items, **kwargs) -> AsyncIterator[bytes]:
+    """Stream a comment thread as JSON bytes, with their posters written once each.
+
+    :param comments: The :class:`pantsuBooru.models.Comment` rows.
+    :param kwargs: Passed to :func:`stream_list`.
+    """
+    def encode(comment, users, referenced):
+        referenced.add(comment.poster)
+        return comment_json(comment)
+
+    return stream_list("comments", comments, encode, **kwargs)
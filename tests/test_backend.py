@@ -0,0 +1,215 @@
+import asyncio
+import random
+
+import pytest
+
+from pantsuBooru.backend import BadQuery
+from pantsuBooru.backend.autocomplete import CACHE_THRESHOLD, TagAutocomplete
+from pantsuBooru.backend.cache import LRUCache
+from pantsuBooru.backend.feed import FeedBuffer
+from pantsuBooru.backend.query import (ALL, NOTHING, AndTerm, NotTerm, OrTerm, TagTerm,
+                                       evaluate, parse_query, plan)
+from pantsuBooru.backend.records import ImageRecord
+from pantsuBooru.backend.tag_index import Bitmap, TagIndex
+from pantsuBooru.backend.writer import WriteQueue
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def random_index(rng: random.Random, images: int=2000, tags: int=8) -> TagIndex:
+    index = TagIndex()
+    for i in range(images):
+        index.add(i * rng.randint(1, 7), *(f"t{j}" for j in range(tags) if rng.random() < 0.3))
+    return index
+
+
+def test_parse_precedence():
+    a, b, c = TagTerm("a"), TagTerm("b"), TagTerm("c")
+    assert parse_query("A b OR c") == OrTerm((AndTerm((a, b)), c))
+    assert parse_query("a (b | c)") == AndTerm((a, OrTerm((b, c))))
+    assert parse_query("-a NOT (b c)") == AndTerm((NotTerm(a), NotTerm(AndTerm((b, c)))))
+
+
+@pytest.mark.parametrize("query", ["", "a OR", "(a b", "a )", "a | | b"])
+def test_parse_invalid(query):
+    with pytest.raises(BadQuery):
+        parse_query(query)
+
+
+def test_plan_folds_missing_and_uncounted_tags():
+    assert plan(parse_query("t1"), {"t1": 0}) == NOTHING
+    assert plan(parse_query("t1"), {}) == NOTHING
+    assert plan(parse_query("-t1"), {"t1": 0}) == ALL
+    assert plan(parse_query("a missing"), {"a": 5}) == NOTHING
+    assert plan(parse_query("a | missing"), {"a": 5}) == TagTerm("a")
+    assert plan(parse_query("NOT -a"), {"a": 5}) == TagTerm("a")
+
+
+def test_plan_orders_and_flattens():
+    counts = {"rare": 1, "common": 100, "mid": 10}
+    assert plan(parse_query("common (rare mid)"), counts) == \
+        AndTerm((TagTerm("rare"), TagTerm("mid"), TagTerm("common")))
+    assert plan(parse_query("rare | common | rare"), counts) == \
+        OrTerm((TagTerm("common"), TagTerm("rare")))
+
+
+def test_plan_keeps_matches():
+    rng = random.Random(1)
+    index = random_index(rng)
+    counts = {tag: len(bitmap) for tag, bitmap in index.tags.items()}
+    tags = [f"t{i}" for i in range(10)]  # t8 and t9 are on no image
+
+    def brute(term, image_id):
+        if isinstance(term, TagTerm):
+            return term.tag in index.image_tags[image_id]
+        if isinstance(term, NotTerm):
+            return not brute(term.term, image_id)
+        combine = all if isinstance(term, AndTerm) else any
+        return combine(brute(i, image_id) for i in term.terms)
+
+    for _ in range(200):
+        words = []
+        for _ in range(rng.randint(1, 5)):
+            words.append(rng.choice(["", "-"]) + rng.choice(tags))
+            words.append(rng.choice(["", "OR"]))
+        term = parse_query(" ".join(words[:-1]))
+        expected = {i for i in index.image_tags if brute(term, i)}
+        assert set(evaluate(plan(term, counts), index)) == expected
+
+
+def test_bitmap_matches_sets():
+    rng = random.Random(2)
+    a = {rng.randrange(50000) for _ in range(3000)}
+    b = {rng.randrange(50000) for _ in range(3000)}
+    x, y = Bitmap(a), Bitmap(b)
+
+    assert list(x) == sorted(a) and len(x) == len(a)
+    assert list(x & y) == sorted(a & b)
+    assert list(x | y) == sorted(a | b)
+    assert list(x ^ y) == sorted(a ^ b)
+    assert list(x - y) == sorted(a - b)
+    assert list(x.descending(25000)) == sorted((i for i in a if i < 25000), reverse=True)
+
+    for i in list(a)[:1000]:
+        x.discard(i)
+        a.discard(i)
+    assert list(x) == sorted(a)
+
+
+def test_rank_matches_brute_force():
+    rng = random.Random(3)
+    index = random_index(rng)
+    for _ in range(50):
+        tags = rng.sample([f"t{i}" for i in range(8)], rng.randint(1, 8))
+        expected = sorted(((i, len(index.image_tags[i] & set(tags))) for i in index.image_tags),
+                          key=lambda i: (i[1], i[0]), reverse=True)
+        expected = [i for i in expected if i[1]]
+
+        assert index.rank(*tags, limit=len(expected) + 1) == expected
+
+        # Paging with the keyset cursor gives the same results
+        pages, after = [], None
+        while True:
+            page = index.rank(*tags, limit=37, after=after)
+            pages.extend(page)
+            if len(page) < 37:
+                break
+            after = page[-1][::-1]
+        assert pages == expected
+
+
+def test_autocomplete_cache_stays_correct():
+    rng = random.Random(4)
+    # Enough tags under "a" for its top tags to be cached
+    names = [f"a{i:04}" for i in range(CACHE_THRESHOLD * 2)]
+    counts = {i: rng.randint(1, 20) for i in names}
+    autocomplete = TagAutocomplete(counts.items())
+
+    def expected(prefix, limit):
+        matches = [(t, c) for t, c in counts.items() if t.startswith(prefix) and c > 0]
+        return sorted(matches, key=lambda i: (i[1], i[0]), reverse=True)[:limit]
+
+    assert autocomplete.complete("a", 10) == expected("a", 10)
+    for _ in range(2000):
+        tag = rng.choice(names)
+        action = rng.random()
+        if action < 0.4:
+            autocomplete.add(tag)
+            counts[tag] = counts.get(tag, 0) + 1
+        elif action < 0.8:
+            autocomplete.remove(tag)
+            counts[tag] = max(counts.get(tag, 0) - 1, 0)
+        else:
+            count = rng.randint(0, 30)
+            autocomplete.set_counts([(tag, count)])
+            counts[tag] = count
+        prefix = rng.choice(["a", "a0", "a01", tag])
+        assert autocomplete.complete(prefix, 10) == expected(prefix, 10)
+    assert len(autocomplete) == sum(1 for i in counts.values() if i > 0)
+
+
+def test_feed_pages_match_brute_force():
+    rng = random.Random(5)
+    feed = FeedBuffer(size=50)
+    images = {}
+    for i in range(1, 300):
+        if images and rng.random() < 0.2:
+            removed = rng.choice(list(images))
+            del images[removed]
+            feed.remove(removed)
+            continue
+        record = ImageRecord(i, rng.randrange(10), None, None, 1, (), None)
+        images[i] = record
+        feed.add(record)
+
+        newest = sorted(images.values(), key=lambda r: (r.posted_at, r.id), reverse=True)
+        page = feed.page(10)
+        if page is not None:
+            assert page == newest[:10]
+
+
+def test_cache_skips_rows_evicted_during_fetch():
+    cache = LRUCache(maxsize=2)
+    token = cache.token()
+    cache.evict("a")
+    cache.set("a", "stale", token)
+    assert cache.get("a") is None
+
+    token = cache.token()
+    cache.set("a", "fresh", token)
+    assert cache.get("a") == "fresh"
+
+    # Too many evictions to remember which, so older tokens are refused
+    token = cache.token()
+    cache.evict("b", "c", "d")
+    cache.set("e", "unknown", token)
+    assert cache.get("e") is None
+
+
+def test_write_queue_retries_one_by_one():
+    batches = []
+
+    async def write(items):
+        batches.append(list(items))
+        if "bad" in items:
+            raise ValueError("bad write")
+        return [i.upper() for i in items]
+
+    async def main():
+        queue = WriteQueue(write, max_batch=10, max_delay=0.01,
+                           loop=asyncio.get_event_loop())
+        futures = [await queue.put(i) for i in ("a", "bad", "c")]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        await queue.close()
+        return results
+
+    results = run(main())
+    assert results[0] == "A" and results[2] == "C"
+    assert isinstance(results[1], ValueError)
+    assert batches == [["a", "bad", "c"], ["a"], ["bad"], ["c"]]